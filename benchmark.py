@@ -0,0 +1,441 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import random
+import sys
+import threading
+import time
+
+import redis
+
+import chapter1
+import chapter4
+
+
+# 连接Redis：默认连接本地的redis-server，in_process=True时使用进程内的fakeredis代替
+# fakeredis是可选依赖，只有在没有redis-server可用时才需要安装（pip install fakeredis lupa）
+def connect(url='redis://localhost:6379/15', in_process=False):
+    if in_process:
+        import fakeredis
+        return fakeredis.FakeRedis(decode_responses=True)
+    return redis.Redis.from_url(url, decode_responses=True)
+
+
+def percentile(samples, p):
+    # samples必须已经排好序，使用最近秩（nearest-rank）方法计算百分位数
+    if not samples:
+        return 0.0
+    index = max(int(round(p / 100.0 * len(samples))) - 1, 0)
+    return samples[min(index, len(samples) - 1)]
+
+
+def summarize(name, latencies, elapsed, count=None):
+    # count为实际执行的命令数量；使用流水线时每个延迟样本对应一次往返，包含多条命令
+    latencies.sort()
+    count = len(latencies) if count is None else count
+    return {
+        'name': name,
+        'count': count,
+        'ops_per_sec': count / (elapsed or .001),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'p999_ms': percentile(latencies, 99.9) * 1000,
+    }
+
+
+def report(results, fmt='text', out=sys.stdout):
+    if fmt == 'json':
+        json.dump(results, out, indent=2)
+        out.write('\n')
+        return
+    if fmt == 'csv':
+        fields = []
+        for result in results:
+            fields.extend(field for field in result if field not in fields)
+        writer = csv.DictWriter(out, fields)
+        writer.writeheader()
+        writer.writerows(results)
+        return
+    for result in results:
+        out.write('%-40s %10d %12.1f ops/s  p50 %8.3f ms  p99 %8.3f ms  p999 %8.3f ms\n' % (
+            result['name'], result['count'], result['ops_per_sec'],
+            result['p50_ms'], result['p99_ms'], result['p999_ms']))
+
+
+# 第1章投票网站的负载：生成文章、用户和群组，再按照给定的读写比例混合执行
+# post_article()、article_vote()、get_articles()和get_group_articles()
+def populate_chapter1(conn, articles=10000, users=100000, groups=100,
+                      group_size=100):
+    rows = (('user:%s' % random.randrange(users), 'title %s' % i,
+             'http://example.com/%s' % i) for i in range(articles))
+    # 每次生成数据都使用新的导入名称，避免沿用上一次运行留下的导入进度
+    chapter1.post_articles_bulk(conn, rows, name='benchmark:%s' % time.time())
+
+    last_id = int(conn.get('article:'))
+    for group in range(groups):
+        for _ in range(group_size):
+            article_id = str(random.randint(1, last_id))
+            chapter1.add_remove_groups(conn, article_id, ['group%s' % group])
+
+
+CHAPTER1_MIX = {
+    'get_articles': .80,
+    'get_group_articles': .10,
+    'article_vote': .09,
+    'post_article': .01,
+}
+
+
+def run_chapter1(conn, duration=10, users=100000, groups=100, mix=None):
+    mix = mix or CHAPTER1_MIX
+    last_id = int(conn.get('article:') or 0) or 1
+    pages = max(conn.zcard('score:') // chapter1.ARTICLES_PER_PAGE, 1)
+
+    def page():
+        # 越靠前的页面越常被访问
+        return min(int(random.expovariate(.5)) + 1, pages)
+
+    operations = {
+        'get_articles': lambda: chapter1.get_articles(conn, page()),
+        'get_group_articles': lambda: chapter1.get_group_articles(
+            conn, 'group%s' % random.randrange(groups), 1),
+        'article_vote': lambda: chapter1.article_vote(
+            conn, 'user:%s' % random.randrange(users),
+            'article:%s' % random.randint(1, last_id)),
+        'post_article': lambda: chapter1.post_article(
+            conn, 'user:%s' % random.randrange(users), 'title',
+            'http://example.com/'),
+    }
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    latencies = dict((name, []) for name in names)
+
+    start = time.time()
+    end = start + duration
+    while time.time() < end:
+        name = random.choices(names, weights)[0]
+        t = time.perf_counter()
+        operations[name]()
+        latencies[name].append(time.perf_counter() - t)
+    elapsed = time.time() - start
+
+    results = [summarize(name, latencies[name], elapsed) for name in names]
+    results.append(summarize(
+        'total', [l for name in names for l in latencies[name]], elapsed))
+    return results
+
+
+# 第3章各类命令的延迟测试：字符串和二进制位、列表和阻塞弹出、集合、散列、
+# 有序集合（包括ZINTERSTORE/ZUNIONSTORE）以及SORT BY/GET
+# 每个族先用setup()准备size个元素的数据，再返回需要测试的(命令名, 函数)列表，
+# 函数的参数为连接或者流水线以及当前的序号
+def strings_family(conn, size):
+    conn.set('bench:string', 'x' * size)
+    conn.set('bench:counter', 0)
+    bits = size * 8
+    return [
+        ('get', lambda c, i: c.get('bench:string')),
+        ('incr', lambda c, i: c.incr('bench:counter')),
+        ('getrange', lambda c, i: c.getrange('bench:string', 0, 15)),
+        ('setrange', lambda c, i: c.setrange('bench:string', i % size, 'y')),
+        ('setbit', lambda c, i: c.setbit('bench:string', i % bits, i & 1)),
+        ('getbit', lambda c, i: c.getbit('bench:string', i % bits)),
+        ('bitcount', lambda c, i: c.bitcount('bench:string')),
+    ]
+
+
+def lists_family(conn, size):
+    conn.rpush('bench:list', *range(size))
+    return [
+        ('lindex', lambda c, i: c.lindex('bench:list', size // 2)),
+        ('lrange_10', lambda c, i: c.lrange('bench:list', 0, 9)),
+        ('rpoplpush', lambda c, i: c.rpoplpush('bench:list', 'bench:list')),
+        # 列表不为空，阻塞弹出会立即返回；把元素移回原列表以保持长度不变
+        ('brpoplpush', lambda c, i: c.brpoplpush('bench:list', 'bench:list', 1)),
+        ('lpush_rpop', lambda c, i: (c.lpush('bench:list', i), c.rpop('bench:list'))),
+    ]
+
+
+def sets_family(conn, size):
+    conn.sadd('bench:set1', *range(size))
+    conn.sadd('bench:set2', *range(size // 2, size + size // 2))
+    return [
+        ('sismember', lambda c, i: c.sismember('bench:set1', i % size)),
+        ('sadd_srem', lambda c, i: (c.sadd('bench:set1', -i - 1), c.srem('bench:set1', -i - 1))),
+        ('scard', lambda c, i: c.scard('bench:set1')),
+        ('sinterstore', lambda c, i: c.sinterstore('bench:set3', ['bench:set1', 'bench:set2'])),
+        ('sunionstore', lambda c, i: c.sunionstore('bench:set3', ['bench:set1', 'bench:set2'])),
+    ]
+
+
+def hashes_family(conn, size):
+    conn.hset('bench:hash', mapping=dict(('f%s' % i, i) for i in range(size)))
+    return [
+        ('hget', lambda c, i: c.hget('bench:hash', 'f%s' % (i % size))),
+        ('hset', lambda c, i: c.hset('bench:hash', 'f%s' % (i % size), i)),
+        ('hincrby', lambda c, i: c.hincrby('bench:hash', 'f%s' % (i % size))),
+        ('hmget_10', lambda c, i: c.hmget('bench:hash', ['f%s' % (j % size) for j in range(i, i + 10)])),
+        ('hgetall', lambda c, i: c.hgetall('bench:hash')),
+    ]
+
+
+def zsets_family(conn, size):
+    conn.zadd('bench:zset1', dict((str(i), i) for i in range(size)))
+    conn.zadd('bench:zset2', dict((str(i), i) for i in range(size // 2, size + size // 2)))
+    return [
+        ('zscore', lambda c, i: c.zscore('bench:zset1', str(i % size))),
+        ('zincrby', lambda c, i: c.zincrby('bench:zset1', 1, str(i % size))),
+        ('zrank', lambda c, i: c.zrank('bench:zset1', str(i % size))),
+        ('zrevrange_10', lambda c, i: c.zrevrange('bench:zset1', 0, 9)),
+        ('zinterstore', lambda c, i: c.zinterstore('bench:zset3', ['bench:zset1', 'bench:zset2'])),
+        ('zunionstore', lambda c, i: c.zunionstore('bench:zset3', ['bench:zset1', 'bench:zset2'])),
+    ]
+
+
+def sort_family(conn, size):
+    pipe = conn.pipeline(False)
+    pipe.rpush('bench:sort', *range(size))
+    for i in range(size):
+        pipe.hset('bench:d-%s' % i, 'field', random.randrange(size))
+    pipe.execute()
+    return [
+        ('sort', lambda c, i: c.sort('bench:sort', start=0, num=10)),
+        ('sort_by', lambda c, i: c.sort('bench:sort', start=0, num=10, by='bench:d-*->field')),
+        ('sort_by_get', lambda c, i: c.sort(
+            'bench:sort', start=0, num=10, by='bench:d-*->field', get='bench:d-*->field')),
+    ]
+
+
+COMMAND_FAMILIES = {
+    'strings': strings_family,
+    'lists': lists_family,
+    'sets': sets_family,
+    'hashes': hashes_family,
+    'zsets': zsets_family,
+    'sort': sort_family,
+}
+
+
+def clean_bench_keys(conn):
+    keys = list(conn.scan_iter('bench:*', count=1000))
+    for i in range(0, len(keys), 1000):
+        conn.delete(*keys[i:i + 1000])
+
+
+def run_commands(conn, families=None, sizes=(100, 1000, 10000), depths=(1, 100),
+                 iterations=1000):
+    # depth为1时逐条发送命令，否则每depth条命令组成一个非事务流水线
+    results = []
+    for family in families or sorted(COMMAND_FAMILIES):
+        for size in sizes:
+            clean_bench_keys(conn)
+            for command, function in COMMAND_FAMILIES[family](conn, size):
+                for depth in depths:
+                    latencies = []
+                    start = time.time()
+                    for batch in range(0, iterations, depth):
+                        t = time.perf_counter()
+                        if depth == 1:
+                            function(conn, batch)
+                        else:
+                            pipe = conn.pipeline(False)
+                            for i in range(batch, min(batch + depth, iterations)):
+                                function(pipe, i)
+                            pipe.execute()
+                        latencies.append(time.perf_counter() - t)
+                    result = summarize(
+                        '%s.%s size=%s depth=%s' % (family, command, size, depth),
+                        latencies, time.time() - start, iterations)
+                    result.update(
+                        family=family, command=command, size=size, depth=depth)
+                    results.append(result)
+    clean_bench_keys(conn)
+    return results
+
+
+# 扩展chapter4.benchmark_update_token()：比较逐条发送命令、流水线和脚本三种实现，
+# 分别在多个线程或者进程、多种流水线深度下运行
+# 深度大于1时，depth次update_token()调用被放进同一个非事务流水线里，
+# 此时update_token和update_token_pipeline发送的命令相同，所以只测试前者
+UPDATE_TOKEN_VARIANTS = ('update_token', 'update_token_pipeline', 'update_token_script')
+
+
+def count_round_trips(conn, counter):
+    # 包装连接，统计与Redis之间的通信往返次数：每条单独的命令或者每次执行流水线算作一次
+    execute_command = conn.execute_command
+    pipeline = conn.pipeline
+
+    def counted_command(*args, **kwargs):
+        counter[0] += 1
+        return execute_command(*args, **kwargs)
+
+    def counted_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def counted_execute(*args, **kwargs):
+            counter[0] += 1
+            return execute(*args, **kwargs)
+        pipe.execute = counted_execute
+        return pipe
+
+    conn.execute_command = counted_command
+    conn.pipeline = counted_pipeline
+    return conn
+
+
+def connect_like(conn):
+    # 每个线程使用自己的客户端对象（共用连接池），这样统计往返次数时互不干扰
+    return redis.Redis(connection_pool=conn.connection_pool)
+
+
+def update_token_worker(conn, variant, depth, duration, worker):
+    counter = [0]
+    conn = count_round_trips(conn, counter)
+    function = getattr(chapter4, variant)
+    latencies = []
+    ops = 0
+    end = time.time() + duration
+    while time.time() < end:
+        t = time.perf_counter()
+        if depth == 1:
+            function(conn, 'token:%s' % worker, 'user', 'item:%s' % (ops % 100))
+        else:
+            pipe = conn.pipeline(False)
+            for i in range(ops, ops + depth):
+                if variant == 'update_token_script':
+                    function(pipe, 'token:%s' % worker, 'user', 'item:%s' % (i % 100), True)
+                else:
+                    function(pipe, 'token:%s' % worker, 'user', 'item:%s' % (i % 100))
+            pipe.execute()
+        latencies.append(time.perf_counter() - t)
+        ops += depth
+    return latencies, ops, counter[0]
+
+
+def _update_token_process(args):
+    url, variant, depth, duration, worker = args
+    return update_token_worker(connect(url), variant, depth, duration, worker)
+
+
+def run_update_token(conn, url=None, variants=UPDATE_TOKEN_VARIANTS,
+                     modes=('thread',), concurrency=(1, 2, 4, 8),
+                     depths=(1, 10, 100), duration=2):
+    # mode为process时每个进程按url重新连接，因此不能与进程内的fakeredis一起使用
+    results = []
+    for variant in variants:
+        for depth in depths:
+            if depth > 1 and variant == 'update_token_pipeline':
+                continue
+            for mode in modes:
+                for workers in concurrency:
+                    start = time.time()
+                    if mode == 'process':
+                        pool = multiprocessing.Pool(workers)
+                        try:
+                            outcomes = pool.map(_update_token_process, [
+                                (url, variant, depth, duration, i) for i in range(workers)])
+                        finally:
+                            pool.close()
+                            pool.join()
+                    else:
+                        outcomes = [None] * workers
+
+                        def run(i):
+                            outcomes[i] = update_token_worker(
+                                connect_like(conn), variant, depth, duration, i)
+                        threads = [threading.Thread(target=run, args=(i,))
+                                   for i in range(workers)]
+                        for thread in threads:
+                            thread.start()
+                        for thread in threads:
+                            thread.join()
+                    elapsed = time.time() - start
+
+                    latencies = []
+                    for samples, ops, round_trips in outcomes:
+                        latencies.extend(samples)
+                    ops = sum(outcome[1] for outcome in outcomes)
+                    round_trips = sum(outcome[2] for outcome in outcomes)
+                    result = summarize(
+                        '%s depth=%s %s=%s' % (variant, depth, mode, workers),
+                        latencies, elapsed, ops)
+                    result.update(
+                        variant=variant, depth=depth, mode=mode, workers=workers,
+                        round_trips_per_op=round_trips / (ops or 1))
+                    results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='redis://localhost:6379/15')
+    parser.add_argument('--in-process', action='store_true')
+    parser.add_argument('--flush', action='store_true',
+                        help='清空目标数据库之后再生成数据')
+    parser.add_argument('--format', choices=('text', 'json', 'csv'), default='text')
+    parser.add_argument('--output', help='结果写入的文件，默认输出到标准输出')
+    workloads = parser.add_subparsers(dest='workload', required=True)
+
+    chapter1_parser = workloads.add_parser('chapter1')
+    chapter1_parser.add_argument('--articles', type=int, default=10000)
+    chapter1_parser.add_argument('--users', type=int, default=100000)
+    chapter1_parser.add_argument('--groups', type=int, default=100)
+    chapter1_parser.add_argument('--duration', type=float, default=10)
+    chapter1_parser.add_argument('--reads', type=float, default=.9,
+                                 help='读操作所占的比例')
+
+    commands_parser = workloads.add_parser('commands')
+    commands_parser.add_argument('--families', default=','.join(sorted(COMMAND_FAMILIES)))
+    commands_parser.add_argument('--sizes', default='100,1000,10000')
+    commands_parser.add_argument('--depths', default='1,100')
+    commands_parser.add_argument('--iterations', type=int, default=1000)
+    token_parser = workloads.add_parser('update_token')
+    token_parser.add_argument('--variants', default=','.join(UPDATE_TOKEN_VARIANTS))
+    token_parser.add_argument('--modes', default='thread',
+                              help='thread、process或者两者，以逗号分隔')
+    token_parser.add_argument('--concurrency', default='1,2,4,8')
+    token_parser.add_argument('--depths', default='1,10,100')
+    token_parser.add_argument('--duration', type=float, default=2)
+    args = parser.parse_args()
+
+    conn = connect(args.url, args.in_process)
+    if args.flush:
+        conn.flushdb()
+
+    if args.workload == 'chapter1':
+        populate_chapter1(conn, args.articles, args.users, args.groups)
+        writes = 1 - args.reads
+        mix = {
+            'get_articles': args.reads * .9,
+            'get_group_articles': args.reads * .1,
+            'article_vote': writes * .9,
+            'post_article': writes * .1,
+        }
+        results = run_chapter1(conn, args.duration, args.users, args.groups, mix)
+    elif args.workload == 'update_token':
+        if args.in_process and 'process' in args.modes:
+            parser.error('进程内的fakeredis不能在多个进程之间共享')
+        results = run_update_token(
+            conn, args.url, args.variants.split(','), args.modes.split(','),
+            [int(workers) for workers in args.concurrency.split(',')],
+            [int(depth) for depth in args.depths.split(',')],
+            args.duration)
+    else:
+        results = run_commands(
+            conn, args.families.split(','),
+            [int(size) for size in args.sizes.split(',')],
+            [int(depth) for depth in args.depths.split(',')],
+            args.iterations)
+
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        report(results, args.format, out)
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,9 @@
+import itertools
+import random
 import time
 
+from chapter11 import script_load
+
 ONE_WEEK_IN_SECONDS = 7 * 86400
 VOTE_SCORE = 432
 
@@ -28,14 +32,128 @@ def article_vote(conn, user, article):
         conn.hincrby(article, 'votes', 1)
 
 
+_article_vote = article_vote
+
+# 投票结果：投票成功、重复投票、文章已超过投票期限（或不存在）
+VOTE_ACCEPTED = 1
+VOTE_DUPLICATE = 0
+VOTE_EXPIRED = -1
+# 每次脚本调用最多处理的投票数量，避免单个脚本长时间阻塞Redis
+VOTE_BATCH_SIZE = 1000
+
+# 投票用户的记录方式：'set'为每篇文章一个voted:id集合；
+# 'bitmap'按数字用户ID在分片位图'votedbits:id:shard'中设置对应的二进制位，
+# 每个分片包含VOTER_SHARD_BITS个用户，ID稀疏时只会创建实际用到的分片
+VOTER_BACKEND = 'set'
+VOTER_SHARD_BITS = 2 ** 16
+
+
+def user_id_of(user):
+    # 用户标识的格式为user:id
+    return int(str(user).rpartition(':')[-1])
+
+
+def voter_key(article_id, user, voters=VOTER_BACKEND):
+    # 返回记录投票的键以及写入其中的成员（集合）或偏移量（位图）
+    if voters == 'bitmap':
+        shard, offset = divmod(user_id_of(user), VOTER_SHARD_BITS)
+        return 'votedbits:%s:%s' % (article_id, shard), offset
+    return 'voted:' + article_id, user
+
+
+# 使用Lua脚本重写的article_vote()函数
+# 检查发布时间、记录投票用户、更新评分和投票数都在一次往返内原子地完成，
+# 不会再出现SADD成功但评分没有更新的情况
+def article_vote(conn, user, article, voters=VOTER_BACKEND):
+    return vote_many(conn, [(user, article)], voters=voters)[0]
+
+
+# 批量投票：votes为(user, article)组成的可迭代对象，返回与之一一对应的投票结果
+def vote_many(conn, votes, batch_size=VOTE_BATCH_SIZE, voters=VOTER_BACKEND):
+    results = []
+    batch = []
+    for vote in votes:
+        batch.append(vote)
+        if len(batch) >= batch_size:
+            results.extend(vote_batch(conn, batch, voters))
+            batch = []
+    if batch:
+        results.extend(vote_batch(conn, batch, voters))
+    return results
+
+
+def vote_batch(conn, batch, voters=VOTER_BACKEND):
+    cutoff = time.time() - ONE_WEEK_IN_SECONDS
+    keys = ['time:', 'score:', 'version:score:', 'version:time:']
+    args = [cutoff, VOTE_SCORE, voters, ONE_WEEK_IN_SECONDS]
+    for user, article in batch:
+        # 每一票对应三个键：记录投票用户的键、文章散列以及记录文章所属群组的groups:id集合
+        article_id = article.partition(':')[-1]
+        voted, member = voter_key(article_id, user, voters)
+        keys.append(voted)
+        keys.append(article)
+        keys.append('groups:' + article_id)
+        args.append(member)
+    return article_vote_lua(conn, keys, args)
+
+
+article_vote_lua = script_load('''
+local cutoff = tonumber(ARGV[1])
+local score = tonumber(ARGV[2])
+local bitmap = ARGV[3] == 'bitmap'
+local week = tonumber(ARGV[4])
+local function record(voted, voter, posted)
+    if not bitmap then
+        return redis.call('sadd', voted, voter) == 1
+    end
+    if redis.call('setbit', voted, voter, 1) == 1 then
+        return false
+    end
+    -- 位图分片在投票时才创建，过期时间与文章的投票期限一致
+    redis.call('expireat', voted, math.ceil(tonumber(posted) + week))
+    return true
+end
+local results = {}
+local accepted = 0
+for i = 5, #ARGV do
+    local voted = KEYS[3 * i - 10]
+    local article = KEYS[3 * i - 9]
+    local posted = redis.call('zscore', KEYS[1], article)
+    if not posted or tonumber(posted) < cutoff then
+        results[#results + 1] = -1
+    elseif record(voted, ARGV[i], posted) then
+        redis.call('zincrby', KEYS[2], score, article)
+        redis.call('hincrby', article, 'votes', 1)
+        -- 同步更新文章所属群组的评分排行，XX保证只更新已经维护好的排行
+        for _, group in ipairs(redis.call('smembers', KEYS[3 * i - 8])) do
+            redis.call('zadd', KEYS[2] .. group, 'XX', 'INCR', score, article)
+        end
+        results[#results + 1] = 1
+        accepted = accepted + 1
+    else
+        results[#results + 1] = 0
+    end
+end
+if accepted > 0 then
+    -- 两种排序的缓存页面都包含文章散列中的votes字段，所以两个版本号都要递增
+    redis.call('incr', KEYS[3])
+    redis.call('incr', KEYS[4])
+end
+return results
+''')
+
+
 # 代码清单1-7 post_article()函数
-def post_article(conn, user, title, link):
+def post_article(conn, user, title, link, voters=VOTER_BACKEND):
     # str()函数将对象转化为适于人阅读的形式。
     # 生产新的文章ID
     article_id = str(conn.incr('article:'))
 
-    voted = 'voted:' + article_id
-    conn.sadd(voted, user)
+    voted, member = voter_key(article_id, user, voters)
+    if voters == 'bitmap':
+        conn.setbit(voted, member, 1)
+    else:
+        conn.sadd(voted, member)
     conn.expire(voted, ONE_WEEK_IN_SECONDS)
 
     now = time.time()
@@ -48,11 +166,94 @@ def post_article(conn, user, title, link):
         'time': now,
         'votes': 1,
     })
-    conn.zadd('score:', article, now + VOTE_SCORE)
-    conn.zadd('time:', article, now)
+    conn.zadd('score:', {article: now + VOTE_SCORE})
+    conn.zadd('time:', {article: now})
+    bump_versions(conn, 'score:', 'time:')
     return article_id
 
 
+# 批量导入文章：一次INCRBY预留一段文章ID，输入按大小受限的事务流水线分批写入
+# articles：由(user, title, link)或(user, title, link, posted)组成的可迭代对象
+# 导入进度（已经写入的文章数量以及尚未使用的预留ID）与每批数据在同一个事务中提交，
+# 崩溃之后使用相同的name和输入重新调用即可从中断处继续，不会重复写入
+IMPORT_BLOCK_SIZE = 10000
+IMPORT_PIPELINE_ARTICLES = 1000
+IMPORT_PIPELINE_BYTES = 2 ** 20
+
+
+def post_articles_bulk(conn, articles, name='default',
+                       block_size=IMPORT_BLOCK_SIZE,
+                       max_articles=IMPORT_PIPELINE_ARTICLES,
+                       max_bytes=IMPORT_PIPELINE_BYTES,
+                       voters=VOTER_BACKEND):
+    progress = 'import:' + name
+    done, next_id, last_id = conn.hmget(progress, 'done', 'next', 'last')
+    done = int(done or 0)
+    next_id = int(next_id or 1)
+    last_id = int(last_id or 0)
+
+    start = time.time()
+    imported = 0
+    pending = []
+    size = 0
+    for article in itertools.islice(articles, done, None):
+        if next_id > last_id:
+            last_id = conn.incrby('article:', block_size)
+            next_id = last_id - block_size + 1
+        pending.append((str(next_id),) + tuple(article))
+        next_id += 1
+        size += sum(len(str(value)) for value in article) + 100
+        if len(pending) >= max_articles or size >= max_bytes:
+            done += len(pending)
+            write_articles(conn, pending, progress, done, next_id, last_id, voters)
+            imported += len(pending)
+            pending = []
+            size = 0
+
+    if pending:
+        done += len(pending)
+        write_articles(conn, pending, progress, done, next_id, last_id, voters)
+        imported += len(pending)
+
+    delta = time.time() - start
+    return {'imported': imported, 'done': done, 'seconds': delta,
+            'rate': imported / (delta or .001)}
+
+
+def write_articles(conn, pending, progress, done, next_id, last_id, voters):
+    cutoff = time.time() - ONE_WEEK_IN_SECONDS
+    scores = {}
+    times = {}
+    pipe = conn.pipeline(True)
+    for article_id, user, title, link, posted in (
+            row if len(row) == 5 else row + (time.time(),) for row in pending):
+        posted = float(posted)
+        article = 'article:' + article_id
+        # 还在投票期限内的文章才需要记录发布者的投票
+        if posted >= cutoff:
+            voted, member = voter_key(article_id, user, voters)
+            if voters == 'bitmap':
+                pipe.setbit(voted, member, 1)
+            else:
+                pipe.sadd(voted, member)
+            pipe.expireat(voted, int(posted + ONE_WEEK_IN_SECONDS) + 1)
+        pipe.hset(article, mapping={
+            'title': title,
+            'link': link,
+            'poster': user,
+            'time': posted,
+            'votes': 1,
+        })
+        scores[article] = posted + VOTE_SCORE
+        times[article] = posted
+    pipe.zadd('score:', scores)
+    pipe.zadd('time:', times)
+    pipe.hset(progress, mapping={'done': done, 'next': next_id, 'last': last_id})
+    pipe.incr('version:score:')
+    pipe.incr('version:time:')
+    pipe.execute()
+
+
 # 代码清单1-8 get_articles()函数
 ARTICLES_PER_PAGE = 25
 
@@ -64,16 +265,140 @@ def get_articles(conn, page, order='score:'):
 
     # ZREVRANGE：返回有序集合中指定区间内的成员，通过索引，分数从高到低
     ids = conn.zrevrange(order, start, end)
-    articles = []
+    if len(ids) < ARTICLES_PER_PAGE and order in ARCHIVE_ORDERS:
+        # 这一页超出了在线文章的范围，不足的部分从归档中读取
+        live = conn.zcard(order)
+        ids += get_archived_ids(
+            conn, max(start - live, 0), ARTICLES_PER_PAGE - len(ids), order)
+    # 使用非事务流水线一次取回整页文章，一页25篇文章只需两次往返
+    pipe = conn.pipeline(False)
     for id in ids:
         # HGETALL：获取在哈希表中指定key的所有字段和值
         # id中存储的格式是'article:id'
-        article_data = conn.hgetall(id)
+        pipe.hgetall(id)
+    articles = []
+    for id, article_data in zip(ids, pipe.execute()):
         article_data['id'] = id
         articles.append(article_data)
     return articles
 
 
+# 归档：超过投票期限的文章会被移出score:和time:以及群组排行，按发布时间所在的周存放在
+# 'archive:score:<week>'和'archive:time:<week>'两个有序集合中，分值分别为评分和发布时间，
+# 翻页时只需读取需要的区间；'archive:'有序集合记录所有已经存在的周
+ARCHIVE_ORDERS = ('score:', 'time:')
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_INTERVAL = 60
+QUIT = False
+
+
+def get_archived_ids(conn, offset, count, order='score:'):
+    # 归档中的文章按周从新到旧排列，同一周内按order排序
+    weeks = conn.zrevrange('archive:', 0, -1)
+    pipe = conn.pipeline(False)
+    for week in weeks:
+        pipe.zcard('archive:%s%s' % (order, week))
+
+    ids = []
+    for week, size in zip(weeks, pipe.execute()):
+        if offset >= size:
+            offset -= size
+            continue
+        ids.extend('article:' + id for id in conn.zrevrange(
+            'archive:%s%s' % (order, week), offset, offset + count - len(ids) - 1))
+        offset = 0
+        if len(ids) >= count:
+            break
+    return ids
+
+
+# 守护进程函数archive_articles()：分批把超过投票期限的文章移入归档，
+# 每批都由一次脚本调用原子地完成，单批的大小限制了脚本阻塞Redis的时间
+def archive_articles(conn, batch_size=ARCHIVE_BATCH_SIZE):
+    while not QUIT:
+        archived = archive_batch(conn, batch_size)
+        if archived < batch_size:
+            time.sleep(ARCHIVE_INTERVAL)
+
+
+def archive_batch(conn, batch_size=ARCHIVE_BATCH_SIZE):
+    cutoff = time.time() - ONE_WEEK_IN_SECONDS
+    return archive_batch_lua(
+        conn, ['time:', 'score:', 'archive:', 'version:score:', 'version:time:'],
+        [cutoff, batch_size, ONE_WEEK_IN_SECONDS])
+
+
+archive_batch_lua = script_load('''
+local expired = redis.call('zrangebyscore', KEYS[1], '-inf', '(' .. ARGV[1],
+    'WITHSCORES', 'LIMIT', 0, tonumber(ARGV[2]))
+for i = 1, #expired, 2 do
+    local article = expired[i]
+    local posted = expired[i + 1]
+    local score = redis.call('zscore', KEYS[2], article) or posted
+    local week = math.floor(tonumber(posted) / tonumber(ARGV[3]))
+    local id = string.sub(article, string.find(article, ':', 1, true) + 1)
+    redis.call('zadd', KEYS[3] .. KEYS[2] .. week, score, id)
+    redis.call('zadd', KEYS[3] .. KEYS[1] .. week, posted, id)
+    redis.call('zadd', KEYS[3], week, week)
+    redis.call('zrem', KEYS[1], article)
+    redis.call('zrem', KEYS[2], article)
+    -- 群组排行只包含在线文章，反向索引groups:id也随之删除
+    for _, group in ipairs(redis.call('smembers', 'groups:' .. id)) do
+        redis.call('zrem', KEYS[1] .. group, article)
+        redis.call('zrem', KEYS[2] .. group, article)
+    end
+    redis.call('del', 'groups:' .. id)
+    -- 文章已经不能再投票，投票记录不必等到过期
+    redis.call('del', 'voted:' .. id)
+end
+if #expired > 0 then
+    redis.call('incr', KEYS[4])
+    redis.call('incr', KEYS[5])
+end
+return #expired / 2
+''')
+
+
+# 进程内的页面缓存：键为(order, page)，值为(版本号, 文章列表)
+# article_vote()、post_article()和归档会递增版本号'version:<order>'（投票会改变两种排序页面上的votes字段），
+# 缓存的页面在版本号变化之后失效
+PAGE_CACHE = {}
+ORDER_VERSIONS = {}
+CACHED_ORDERS = ('score:', 'time:')
+CACHED_PAGES = 20
+
+
+def bump_versions(conn, *orders):
+    pipe = conn.pipeline(False)
+    for order in orders:
+        pipe.incr('version:' + order)
+    pipe.execute()
+
+
+def get_order_version(conn, order, wait=1):
+    # 版本号最多每wait秒向Redis查询一次，其余时间直接使用本地记录的版本号
+    version, checked = ORDER_VERSIONS.get(order, (None, 0))
+    if checked < time.time() - wait:
+        version = conn.get('version:' + order)
+        ORDER_VERSIONS[order] = (version, time.time())
+    return version
+
+
+def get_articles_cached(conn, page, order='score:', wait=1):
+    if order not in CACHED_ORDERS or page > CACHED_PAGES:
+        return get_articles(conn, page, order)
+
+    # 先读取版本号再读取文章，缓存的页面至少和它的版本号一样新
+    version = get_order_version(conn, order, wait)
+    cached = PAGE_CACHE.get((order, page))
+    if cached and cached[0] == version:
+        return cached[1]
+
+    articles = get_articles(conn, page, order)
+    PAGE_CACHE[(order, page)] = (version, articles)
+    return articles
+
+
 # 代码清单1-9 add_remove_groups()函数
 def add_remove_groups(conn, article_id, to_add=[], to_remove=[]):
     article = 'article:' + article_id
@@ -91,3 +416,111 @@ def get_group_articles(conn, group, page, order='score:'):
         conn.zinterstore(key, ['group:' + group, order], aggregate='max')
         conn.expire(key, 60)
     return get_articles(conn, page, key)
+
+
+_add_remove_groups = add_remove_groups
+_get_group_articles = get_group_articles
+
+# 在写入时维护的群组排行：score:<group>和time:<group>不再每60秒通过ZINTERSTORE重建，
+# 而是在群组变化和投票时增量更新，开销只与群组大小有关
+GROUP_ORDERS = ('score:', 'time:')
+
+
+# 使用Lua脚本重写的add_remove_groups()函数
+# groups:id集合记录文章所属的群组，投票时据此更新各个群组的排行
+def add_remove_groups(conn, article_id, to_add=[], to_remove=[]):
+    article = 'article:' + article_id
+    return add_remove_groups_lua(
+        conn, [article, 'groups:' + article_id] + list(GROUP_ORDERS),
+        [len(to_add)] + list(to_add) + list(to_remove))
+
+
+add_remove_groups_lua = script_load('''
+local article = KEYS[1]
+local nadd = tonumber(ARGV[1])
+for i = 2, #ARGV do
+    local group = ARGV[i]
+    if i <= nadd + 1 then
+        redis.call('sadd', 'group:' .. group, article)
+        redis.call('sadd', KEYS[2], group)
+        for j = 3, #KEYS do
+            -- 只更新已经存在的排行；新群组的第一篇文章会创建排行，
+            -- 其余缺失的排行交给get_group_articles()重建
+            local ranking = KEYS[j] .. group
+            local score = redis.call('zscore', KEYS[j], article)
+            if score and (redis.call('exists', ranking) == 1 or
+                    redis.call('scard', 'group:' .. group) == 1) then
+                redis.call('zadd', ranking, score, article)
+            end
+        end
+    else
+        redis.call('srem', 'group:' .. group, article)
+        redis.call('srem', KEYS[2], group)
+        for j = 3, #KEYS do
+            redis.call('zrem', KEYS[j] .. group, article)
+        end
+    end
+end
+''')
+
+
+# 修改后的get_group_articles()函数
+# 只有排行不存在时（例如升级前就已经存在的群组）才需要重建，重建由Lua脚本原子地完成，
+# 脚本会先检查排行是否已经存在，所以并发的读取者最多只会有一个真正执行重建
+def get_group_articles(conn, group, page, order='score:'):
+    key = order + group
+    if not conn.exists(key):
+        # 不在写入时维护的排序方式依然使用60秒的过期时间
+        ttl = 0 if order in GROUP_ORDERS else 60
+        rebuild_group_lua(conn, [key, 'group:' + group, order], [group, ttl])
+    return get_articles(conn, page, key)
+
+
+rebuild_group_lua = script_load('''
+if redis.call('exists', KEYS[1]) == 1 then
+    return 0
+end
+local members = redis.call('smembers', KEYS[2])
+for _, article in ipairs(members) do
+    local score = redis.call('zscore', KEYS[3], article)
+    if score then
+        redis.call('zadd', KEYS[1], score, article)
+        -- 顺便补全groups:id反向索引，之后的投票就能增量更新这个排行；
+        -- 已经归档的文章不在排行里，也不需要反向索引
+        local id = string.sub(article, string.find(article, ':', 1, true) + 1)
+        redis.call('sadd', 'groups:' .. id, ARGV[1])
+    end
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('expire', KEYS[1], ARGV[2])
+end
+return #members
+''')
+
+
+# 比较两种投票记录方式的内存占用，返回每一票平均占用的字节数
+def compare_voter_memory(conn, articles=100, votes_per_article=1000,
+                         max_user_id=1000000):
+    report = {}
+    for voters in ('set', 'bitmap'):
+        keys = set()
+        pipe = conn.pipeline(False)
+        for article in range(articles):
+            article_id = 'memtest-%s' % article
+            for _ in range(votes_per_article):
+                user = 'user:%s' % random.randrange(max_user_id)
+                voted, member = voter_key(article_id, user, voters)
+                if voters == 'bitmap':
+                    pipe.setbit(voted, member, 1)
+                else:
+                    pipe.sadd(voted, member)
+                keys.add(voted)
+            pipe.execute()
+
+        for key in keys:
+            pipe.memory_usage(key)
+        used = sum(size or 0 for size in pipe.execute())
+        conn.delete(*keys)
+        report[voters] = used / float(articles * votes_per_article)
+        print(voters, len(keys), used, report[voters])
+    return report
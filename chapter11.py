@@ -1,4 +1,3 @@
-from _typeshed import NoneType
 import bisect
 import math
 import threading
@@ -22,8 +21,12 @@ def script_load(script):
                 return conn.execute_command(
                     "EVALSHA", sha[0], len(keys), *(keys+args))
             except redis.exceptions.ResponseError as msg:
-                if not msg.args[0].startswith("NOSCRIPT"):
+                # 新版redis-py会去掉错误码并抛出NoScriptError；
+                # 脚本缓存被清空（重启、SCRIPT FLUSH或者故障转移）之后，下次调用时重新载入
+                if not isinstance(msg, redis.exceptions.NoScriptError) and \
+                        not msg.args[0].startswith("NOSCRIPT"):
                     raise
+                sha[0] = None
         return conn.execute_command(
             "EVAL", script, len(keys), *(keys+args))
     return call
@@ -300,7 +303,7 @@ def purchase_item_with_lock(conn, buyerid, itemid, sellerid):
         pipe.hget(buyer, 'funds')
         price, funds = pipe.execute()
         if price is None or price > funds:
-            return NoneType
+            return None
 
         pipe.hincrby(seller, 'funds', int(price))
         pipe.hincrby(buyer, 'funds', int(-price))
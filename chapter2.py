@@ -1,6 +1,18 @@
+import atexit
+from collections import defaultdict, OrderedDict
+import functools
+import hashlib
+import math
+import random
+import threading
 import time
 import json
 import urllib.parse
+import uuid
+import zlib
+
+from chapter11 import release_lock, script_load
+from chapter9 import shard_hget, shard_key
 
 
 # 代码清单2-1 check_token()函数
@@ -77,6 +89,184 @@ def clean_full_sessions(conn):
         conn.zrem('recent:', *sessions)
 
 
+# 批量清理会话的函数：每一批会话的删除都由一次脚本调用原子地完成，
+# 脚本在Redis内部重新计算超出LIMIT的数量，所以多个清理进程可以同时运行，
+# 既不会重复删除同一个会话，也不会把会话数量删到LIMIT以下
+CLEAN_MIN_BATCH = 100
+CLEAN_MAX_BATCH = 5000
+CLEAN_IDLE_SLEEP = .25
+
+
+def clean_sessions_batched(conn, carts=False, limit=LIMIT):
+    # carts=True时同时删除会话对应的购物车，相当于clean_full_sessions()
+    batch = CLEAN_MIN_BATCH
+    while not QUIT:
+        deleted, backlog = clean_sessions_lua(
+            conn, ['recent:', 'login:'], [limit, batch, int(bool(carts))])
+        if not deleted:
+            time.sleep(CLEAN_IDLE_SLEEP)
+            continue
+        # 批量大小随积压数量增长，积压越多每次往返删除的会话越多
+        batch = min(max(backlog, CLEAN_MIN_BATCH), CLEAN_MAX_BATCH)
+
+
+clean_sessions_lua = script_load('''
+local excess = redis.call('zcard', KEYS[1]) - tonumber(ARGV[1])
+if excess <= 0 then
+    return {0, 0}
+end
+local tokens = redis.call('zrange', KEYS[1], 0,
+    math.min(excess, tonumber(ARGV[2])) - 1)
+local keys = {}
+for _, token in ipairs(tokens) do
+    keys[#keys + 1] = 'viewed:' .. token
+    if ARGV[3] == '1' then
+        keys[#keys + 1] = 'cart:' .. token
+    end
+end
+-- unpack()能展开的参数数量有限，所以分块执行
+for i = 1, #keys, 1000 do
+    redis.call('del', unpack(keys, i, math.min(i + 999, #keys)))
+end
+for i = 1, #tokens, 1000 do
+    local last = math.min(i + 999, #tokens)
+    redis.call('hdel', KEYS[2], unpack(tokens, i, last))
+    redis.call('zrem', KEYS[1], unpack(tokens, i, last))
+end
+return {#tokens, excess - #tokens}
+''')
+
+
+# 分片存储的会话：login:散列被拆分到许多个小散列'login::<shard>'里面，
+# 每个会话最近浏览的商品不再使用单独的viewed:<token>有序集合，
+# 而是以换行符分隔、最新的在前的字符串形式存放在分片散列'viewed::<shard>'里面。
+# 每个分片平均包含SESSION_SHARD_SIZE/2个元素，需要把hash-max-listpack-entries
+# （旧版本为hash-max-ziplist-entries）设置为不小于SESSION_SHARD_SIZE，分片才能保持紧凑编码
+SESSION_TOTAL = LIMIT
+SESSION_SHARD_SIZE = 512
+RECENT_ITEMS = 25
+
+
+def check_token_sharded(conn, token):
+    return shard_hget(conn, 'login:', token, SESSION_TOTAL, SESSION_SHARD_SIZE)
+
+
+def update_token_sharded(conn, token, user, item=None):
+    keys = [
+        shard_key('login:', token, SESSION_TOTAL, SESSION_SHARD_SIZE),
+        'recent:',
+        shard_key('viewed:', token, SESSION_TOTAL, SESSION_SHARD_SIZE),
+        'viewed:',
+        'decay:viewed:',
+    ]
+    update_token_sharded_lua(
+        conn, keys, [token, user, time.time(), item or '', RECENT_ITEMS, DECAY_PERIOD])
+
+
+def get_recent_items_sharded(conn, token):
+    packed = conn.hget(
+        shard_key('viewed:', token, SESSION_TOTAL, SESSION_SHARD_SIZE), token)
+    return packed.split(b'\n' if isinstance(packed, bytes) else '\n') if packed else []
+
+
+# 所有写入viewed:的脚本共用的权重计算：启用惰性衰减（decay_viewed()设置了'decay:viewed:'）时，
+# 新的浏览记录的权重为2**经过的周期数；没有启用时权重为1，rescale_viewed()依然可以使用
+VIEW_WEIGHT_LUA = '''
+local function view_weight(epoch_key, now, period)
+    local epoch = tonumber(redis.call('get', epoch_key))
+    if not epoch then
+        return 1
+    end
+    return 2 ^ math.floor((now - epoch) / period)
+end
+'''
+
+
+update_token_sharded_lua = script_load(VIEW_WEIGHT_LUA + '''
+redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+redis.call('zadd', KEYS[2], ARGV[3], ARGV[1])
+local item = ARGV[4]
+if item == '' then
+    return
+end
+local items = {item}
+local packed = redis.call('hget', KEYS[3], ARGV[1])
+if packed then
+    for old in string.gmatch(packed, '[^\\n]+') do
+        if #items >= tonumber(ARGV[5]) then
+            break
+        end
+        if old ~= item then
+            items[#items + 1] = old
+        end
+    end
+end
+redis.call('hset', KEYS[3], ARGV[1], table.concat(items, '\\n'))
+redis.call('zincrby', KEYS[4], -view_weight(KEYS[5], tonumber(ARGV[3]), tonumber(ARGV[6])), item)
+''')
+
+
+def clean_sessions_sharded(conn, batch=CLEAN_MAX_BATCH, limit=LIMIT):
+    while not QUIT:
+        size = conn.zcard('recent:')
+        if size <= limit:
+            time.sleep(CLEAN_IDLE_SLEEP)
+            continue
+        tokens = conn.zrange('recent:', 0, min(size - limit, batch) - 1)
+        pipe = conn.pipeline(True)
+        for token in tokens:
+            for base in ('login:', 'viewed:'):
+                pipe.hdel(shard_key(base, token, SESSION_TOTAL, SESSION_SHARD_SIZE), token)
+        pipe.zrem('recent:', *tokens)
+        pipe.execute()
+
+
+# 比较两种会话存储方式的内存占用（不包括两种方式共用的recent:），
+# 数据写入以'memtest:'开头的键，不会影响正在使用的会话
+def session_memory_report(conn, sessions=100000, items=10000, views=10):
+    sessions_data = []
+    for _ in range(sessions):
+        token = str(uuid.uuid4())
+        viewed = ['item%s' % random.randrange(items) for _ in range(views)]
+        sessions_data.append((token, viewed))
+
+    report = {}
+    pipe = conn.pipeline(False)
+    keys = set(['memtest:login:'])
+    for token, viewed in sessions_data:
+        pipe.hset('memtest:login:', token, 'user')
+        pipe.zadd('memtest:viewed:' + token,
+                  dict((item, i) for i, item in enumerate(viewed)))
+        keys.add('memtest:viewed:' + token)
+    pipe.execute()
+    report['before'] = memory_usage(conn, keys)
+
+    keys = set()
+    for token, viewed in sessions_data:
+        for base, value in (('memtest:login:', 'user'),
+                            ('memtest:viewed:', '\n'.join(viewed[::-1]))):
+            shard = shard_key(base, token, SESSION_TOTAL, SESSION_SHARD_SIZE)
+            pipe.hset(shard, token, value)
+            keys.add(shard)
+    pipe.execute()
+    report['after'] = memory_usage(conn, keys)
+
+    report['config'] = conn.config_get('hash-max-*-entries')
+    for name in ('before', 'after'):
+        print(name, report[name], report[name] / float(sessions))
+    print('config', report['config'])
+    return report
+
+
+def memory_usage(conn, keys):
+    pipe = conn.pipeline(False)
+    for key in keys:
+        pipe.memory_usage(key, samples=0)
+    used = sum(size or 0 for size in pipe.execute())
+    conn.delete(*keys)
+    return used
+
+
 # 代码清单2-6 cache_request()函数
 def cache_request(conn, request, callback):
     if not can_cache(conn, request):
@@ -96,6 +286,206 @@ def hash_request(request):
     return str(hash(request))
 
 
+_hash_request = hash_request
+
+# 这些查询参数只用于追踪来源，不影响页面内容
+TRACKING_PARAMS = frozenset(['fbclid', 'gclid', 'msclkid', 'mc_cid', 'mc_eid'])
+TRACKING_PREFIXES = ('utm_',)
+
+
+def canonicalize_request(request):
+    # 协议和主机名转换为小写，去掉片段和追踪参数，其余查询参数按名称排序
+    parsed, query = parse_request(request)
+    params = sorted(
+        (name, value) for name, values in query.items()
+        if name not in TRACKING_PARAMS and not name.startswith(TRACKING_PREFIXES)
+        for value in values)
+    return urllib.parse.urlunparse((
+        parsed.scheme.lower(), parsed.netloc.lower(), parsed.path,
+        parsed.params, urllib.parse.urlencode(params), ''))
+
+
+# 内置的hash()在每个进程中使用不同的随机种子，同一个URL在不同的Web进程中会得到不同的缓存键；
+# 这里改为对规范化之后的请求计算稳定的摘要
+def hash_request(request):
+    return hashlib.blake2b(
+        canonicalize_request(request).encode('utf-8'), digest_size=16).hexdigest()
+
+
+# 进程内的LRU页面缓存：按字节数限制总大小，每个页面只缓存ttl秒，
+# 并记录命中、未命中以及淘汰的次数
+class LocalCache(object):
+    def __init__(self, max_bytes=64 * 2 ** 20, ttl=5):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] < time.time():
+                self._remove(key)
+                entry = None
+            if not entry:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        # 按UTF-8编码后的字节数计算大小，非ASCII页面的字符数会小于实际占用
+        size = len(value.encode('utf-8')) if isinstance(value, str) else len(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, time.time() + self.ttl, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key)[2]
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.size,
+        }
+
+
+# 将LOCAL_CACHE设置为LocalCache实例即可启用进程内缓存层
+LOCAL_CACHE = None
+# 大于COMPRESS_THRESHOLD字节的页面使用zlib压缩之后再存入Redis；
+# 压缩后的数据是二进制的，只能配合decode_responses=False的连接使用
+COMPRESS_PAGES = False
+COMPRESS_THRESHOLD = 1024
+COMPRESSED_PREFIX = b'\x00zlib\x00'
+
+
+def encode_page(content):
+    if not COMPRESS_PAGES or len(content) < COMPRESS_THRESHOLD:
+        return content
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return COMPRESSED_PREFIX + zlib.compress(content)
+
+
+def decode_page(content):
+    # 无论页面是否经过压缩、是否刚刚生成，调用者得到的总是str
+    if isinstance(content, bytes):
+        if content.startswith(COMPRESSED_PREFIX):
+            content = zlib.decompress(content[len(COMPRESSED_PREFIX):])
+        return content.decode('utf-8')
+    return content
+
+
+_cache_request = cache_request
+
+
+# 两级缓存的cache_request()函数：先查进程内缓存，未命中时再查Redis
+def cache_request(conn, request, callback):
+    page_key = 'cache:' + hash_request(request)
+    # 只有通过了can_cache()检查的页面才会进入进程内缓存，
+    # 所以命中时可以跳过can_cache()，完全不需要访问网络
+    content = LOCAL_CACHE and LOCAL_CACHE.get(page_key)
+    if content:
+        return content
+
+    if not can_cache(conn, request):
+        return callback(request)
+    content = decode_page(fetch_single_flight(
+        conn, page_key, lambda: encode_page(callback(request))))
+
+    if LOCAL_CACHE and content:
+        LOCAL_CACHE.set(page_key, content)
+    return content
+
+
+# 防止缓存击穿：缓存过期时只有一个进程负责重新生成内容
+# 缓存键的实际过期时间比逻辑过期时间多STALE_TIMEOUT秒，在此期间其他进程直接返回旧内容；
+# 在逻辑过期之前，还会按照上一次重新生成所花的时间，以一定的概率提前刷新（XFetch算法），
+# 越接近过期、重新生成越慢，提前刷新的概率越大
+CACHE_TIMEOUT = 300
+STALE_TIMEOUT = 30
+EARLY_REFRESH_BETA = 1.0
+REGENERATE_LOCK_TIMEOUT = 10
+REGENERATE_WAIT = .5
+
+
+def fetch_single_flight(conn, key, regenerate, timeout=CACHE_TIMEOUT):
+    pipe = conn.pipeline(False)
+    pipe.get(key)
+    pipe.pttl(key)
+    pipe.get(key + ':delta')
+    content, pttl, delta = pipe.execute()
+
+    if content is not None:
+        # 没有过期时间的键（例如cache_rows()维护的数据行）由其他进程负责刷新
+        if pttl < 0:
+            return content
+        remaining = pttl / 1000.0 - STALE_TIMEOUT
+        delta = float(delta or 0)
+        if remaining + delta * EARLY_REFRESH_BETA * math.log(1 - random.random()) > 0:
+            return content
+        # 已经过期或者被选中提前刷新：拿不到锁说明已经有进程在重新生成，直接返回旧内容
+        identifier = acquire_regenerate_lock(conn, key)
+        if not identifier:
+            return content
+        return regenerate_cached(conn, key, regenerate, timeout, identifier)
+
+    identifier = acquire_regenerate_lock(conn, key)
+    if identifier:
+        return regenerate_cached(conn, key, regenerate, timeout, identifier)
+    # 完全没有旧内容可用：短暂等待持有锁的进程写入新内容，超时之后再自己生成
+    end = time.time() + REGENERATE_WAIT
+    while time.time() < end:
+        time.sleep(.01)
+        content = conn.get(key)
+        if content is not None:
+            return content
+    return regenerate()
+
+
+def acquire_regenerate_lock(conn, key):
+    identifier = str(uuid.uuid4())
+    if conn.set('lock:' + key, identifier, nx=True, ex=REGENERATE_LOCK_TIMEOUT):
+        return identifier
+    return None
+
+
+def regenerate_cached(conn, key, regenerate, timeout, identifier):
+    try:
+        start = time.time()
+        content = regenerate()
+        if content:
+            pipe = conn.pipeline(True)
+            pipe.setex(key, timeout + STALE_TIMEOUT, content)
+            pipe.setex(key + ':delta', timeout + STALE_TIMEOUT, time.time() - start)
+            pipe.execute()
+        return content
+    finally:
+        release_lock(conn, key, identifier)
+
+
+# 通过行缓存读取数据行：由cache_rows()调度的行直接从inv:中读取，
+# 没有被调度的行在未命中时同样只由一个进程从数据库加载
+def get_row(conn, row_id, timeout=CACHE_TIMEOUT):
+    row = fetch_single_flight(
+        conn, 'inv:' + row_id,
+        lambda: json.dumps(Inventory.get(row_id).to_dict()), timeout)
+    return json.loads(row)
+
+
 # 代码清单2-7 schedule_row_cache()函数
 def schedule_row_cache(conn, row_id, delay):
     conn.zadd('delay:', row_id, delay)
@@ -131,10 +521,65 @@ class Inventory(object):
     def get(cls, id):
         return Inventory(id)
 
+    @classmethod
+    def get_many(cls, ids):
+        return [Inventory(id) for id in ids]
+
     def to_dict(self):
         return {'id': self.id, 'data': 'data to cache...', 'cached': time.time()}
 
 
+# 每次循环处理所有到期数据行的调度函数
+# 到期的行由一次脚本调用认领：脚本把这些行重新调度到下一次刷新的时间，
+# 所以多个调度进程可以同时运行，每一行只会被其中一个进程认领
+ROW_CLAIM_LIMIT = 10000
+ROW_FETCH_BATCH = 500
+ROW_MAX_SLEEP = 1
+
+
+def cache_rows_batched(conn, claim_limit=ROW_CLAIM_LIMIT, batch_size=ROW_FETCH_BATCH):
+    while not QUIT:
+        claimed, next_due = claim_rows_lua(
+            conn, ['schedule:', 'delay:'], [time.time(), claim_limit])
+        claimed = [
+            row_id.decode('utf-8') if isinstance(row_id, bytes) else row_id
+            for row_id in claimed]
+
+        pipe = conn.pipeline(False)
+        for i in range(0, len(claimed), batch_size):
+            for row in Inventory.get_many(claimed[i:i + batch_size]):
+                pipe.set('inv:' + row.id, json.dumps(row.to_dict()))
+        pipe.execute()
+
+        if len(claimed) >= claim_limit:
+            continue
+        # 一直休眠到下一行到期为止；新调度的行会立即到期，所以休眠时间不超过ROW_MAX_SLEEP
+        wait = float(next_due) - time.time() if next_due else ROW_MAX_SLEEP
+        time.sleep(min(max(wait, 0), ROW_MAX_SLEEP))
+
+
+claim_rows_lua = script_load('''
+local now = tonumber(ARGV[1])
+local due = redis.call('zrangebyscore', KEYS[1], '-inf', now,
+    'LIMIT', 0, tonumber(ARGV[2]))
+local claimed = {}
+for _, row_id in ipairs(due) do
+    local delay = tonumber(redis.call('zscore', KEYS[2], row_id))
+    if not delay or delay <= 0 then
+        -- 延迟不大于0的行不再缓存
+        redis.call('zrem', KEYS[2], row_id)
+        redis.call('zrem', KEYS[1], row_id)
+        redis.call('del', 'inv:' .. row_id)
+    else
+        redis.call('zadd', KEYS[1], now + delay, row_id)
+        claimed[#claimed + 1] = row_id
+    end
+end
+local first = redis.call('zrange', KEYS[1], 0, 0, 'WITHSCORES')
+return {claimed, first[2] or ''}
+''')
+
+
 # 代码清单2-9 修改后的update_token()函数
 def update_token_modified(conn, token, user, item=None):
     timestamp = time.time()
@@ -144,7 +589,107 @@ def update_token_modified(conn, token, user, item=None):
         conn.zadd('viewed:' + token, item, timestamp)
         # 只保留最新的25个商品
         conn.zremrangebyrank('viewed:' + token, 0, -26)
-        conn.zincrby('viewed:', item, -1)
+        record_views(conn, {item: 1})
+
+
+# update_token_modified()的延迟写入版本：令牌和商品浏览记录先缓存在进程内，
+# 同一个令牌的多次访问只保留最新的时间戳，同一件商品的浏览次数累加之后再写入viewed:，
+# 每隔interval秒或者缓存的令牌达到max_entries个时，用一个流水线统一写入Redis
+class TokenWriteBuffer(object):
+    def __init__(self, conn, interval=.1, max_entries=1000):
+        self.conn = conn
+        self.interval = interval
+        self.max_entries = max_entries
+        self.tokens = {}
+        self.viewed = {}
+        self.counts = defaultdict(int)
+        self.flushes = self.flushed = self.errors = 0
+        self.lock = threading.Lock()
+        # update()在缓存写满时会直接写入，可能与后台线程同时写入；
+        # 写入必须按照交换缓存的顺序执行，否则较早的一批数据会用旧的时间戳覆盖recent:和login:
+        self.flush_lock = threading.Lock()
+        self.quit = threading.Event()
+        self.thread = None
+
+    def update(self, token, user, item=None):
+        timestamp = time.time()
+        with self.lock:
+            self.tokens[token] = (user, timestamp)
+            if item:
+                items = self.viewed.setdefault(token, {})
+                items[item] = timestamp
+                if len(items) > 25:
+                    del items[min(items, key=items.get)]
+                self.counts[item] += 1
+            full = len(self.tokens) >= self.max_entries
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self.lock:
+            tokens, self.tokens = self.tokens, {}
+            viewed, self.viewed = self.viewed, {}
+            counts, self.counts = self.counts, defaultdict(int)
+        if not tokens:
+            return 0
+
+        pipe = self.conn.pipeline(False)
+        pipe.hset('login:', mapping=dict((t, u) for t, (u, ts) in tokens.items()))
+        pipe.zadd('recent:', dict((t, ts) for t, (u, ts) in tokens.items()))
+        for token, items in viewed.items():
+            pipe.zadd('viewed:' + token, items)
+            pipe.zremrangebyrank('viewed:' + token, 0, -26)
+        if counts:
+            record_views(pipe, counts, True)
+        try:
+            pipe.execute()
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            self._requeue(tokens, viewed, counts)
+            raise
+        with self.lock:
+            self.flushes += 1
+            self.flushed += len(tokens)
+        return len(tokens)
+
+    def _requeue(self, tokens, viewed, counts):
+        # 写入失败时把数据放回缓存，保留较新的时间戳，浏览次数继续累加
+        with self.lock:
+            for token, entry in tokens.items():
+                if token not in self.tokens:
+                    self.tokens[token] = entry
+            for token, items in viewed.items():
+                for item, timestamp in items.items():
+                    self.viewed.setdefault(token, {}).setdefault(item, timestamp)
+            for item, count in counts.items():
+                self.counts[item] += count
+
+    def run(self):
+        while not self.quit.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                pass
+        self.flush()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        # 进程退出时写入剩余的数据
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        self.quit.set()
+        if self.thread:
+            self.thread.join()
+        else:
+            self.flush()
 
 
 # 代码清单2-10 守护进程函数rescale_viewed()
@@ -156,23 +701,169 @@ def rescale_viewed(conn):
         time.sleep(300)
 
 
+# 惰性衰减：不再每5分钟把viewed:中的所有分值减半，而是让新的浏览记录的权重每DECAY_PERIOD秒翻一倍，
+# 两者得到的排名完全相同；权重由'decay:viewed:'中记录的起始时间计算，
+# 计算和ZINCRBY在同一个脚本中完成，所以不会和重新归一化交错执行。
+# 本模块中写入viewed:的函数都通过VIEW_WEIGHT_LUA使用同样的权重；
+# decay_viewed()和rescale_viewed()不能同时运行，改回rescale_viewed()时需要先删除'decay:viewed:'
+DECAY_PERIOD = 300
+VIEWED_LIMIT = 20000
+TRIM_CHUNK = 1000
+# 权重达到2**RENORMALIZE_PERIODS（约5小时）之后才把所有分值统一缩小一次，避免浮点数溢出
+RENORMALIZE_PERIODS = 64
+
+
+def update_token_decayed(conn, token, user, item=None):
+    update_token_decayed_lua(
+        conn, ['login:', 'recent:', 'viewed:' + token, 'viewed:', 'decay:viewed:'],
+        [token, user, time.time(), item or '', DECAY_PERIOD])
+
+
+update_token_decayed_lua = script_load(VIEW_WEIGHT_LUA + '''
+local now = tonumber(ARGV[3])
+redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+redis.call('zadd', KEYS[2], now, ARGV[1])
+if ARGV[4] == '' then
+    return
+end
+redis.call('zadd', KEYS[3], now, ARGV[4])
+redis.call('zremrangebyrank', KEYS[3], 0, -26)
+redis.call('zincrby', KEYS[4], -view_weight(KEYS[5], now, tonumber(ARGV[5])), ARGV[4])
+''')
+
+
+# 按当前的衰减权重累加商品的浏览次数，counts为{商品: 浏览次数}；
+# 在流水线里调用时需要传入force_eval=True
+def record_views(conn, counts, force_eval=False):
+    args = [time.time(), DECAY_PERIOD]
+    for item, count in counts.items():
+        args.extend([item, count])
+    return record_views_lua(conn, ['viewed:', 'decay:viewed:'], args, force_eval)
+
+
+record_views_lua = script_load(VIEW_WEIGHT_LUA + '''
+local weight = view_weight(KEYS[2], tonumber(ARGV[1]), tonumber(ARGV[2]))
+for i = 3, #ARGV, 2 do
+    redis.call('zincrby', KEYS[1], -weight * tonumber(ARGV[i + 1]), ARGV[i])
+end
+''')
+
+
+# 守护进程函数decay_viewed()：每一步的开销都有上限
+# 超出VIEWED_LIMIT的商品每次最多删除TRIM_CHUNK个；
+# 归一化只在权重过大时执行，涉及的元素不超过VIEWED_LIMIT个
+def decay_viewed(conn):
+    # 设置起始时间之后，所有写入viewed:的函数都会按照衰减权重累加浏览次数
+    conn.setnx('decay:viewed:', time.time())
+    while not QUIT:
+        while conn.zcard('viewed:') > VIEWED_LIMIT:
+            # 排名越靠前浏览次数越多，从第VIEWED_LIMIT名开始删除
+            conn.zremrangebyrank('viewed:', VIEWED_LIMIT, VIEWED_LIMIT + TRIM_CHUNK - 1)
+        renormalize_viewed_lua(
+            conn, ['viewed:', 'decay:viewed:'],
+            [time.time(), DECAY_PERIOD, RENORMALIZE_PERIODS])
+        time.sleep(DECAY_PERIOD)
+
+
+renormalize_viewed_lua = script_load('''
+local now = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local epoch = tonumber(redis.call('get', KEYS[2]))
+if not epoch then
+    return 0
+end
+local periods = math.floor((now - epoch) / period)
+if periods < tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('zunionstore', KEYS[1], 1, KEYS[1], 'WEIGHTS', 2 ^ -periods)
+redis.call('set', KEYS[2], epoch + periods * period)
+return periods
+''')
+
+
+# viewed:排行的本地快照：后台线程每隔interval秒取回浏览次数最多的size件商品，
+# can_cache()直接在内存中判断商品是否位于前size名，不必每个请求都执行一次ZRANK
+# age()返回快照距离上一次成功刷新的秒数，超过max_age时视为过期
+class ViewedSnapshot(object):
+    def __init__(self, conn, size=10000, interval=5, max_age=None):
+        self.conn = conn
+        self.size = size
+        self.interval = interval
+        self.max_age = max_age or 4 * interval
+        self.members = frozenset()
+        self.refreshed = 0
+        self.refreshes = self.errors = 0
+        self.quit = threading.Event()
+        self.thread = None
+
+    def refresh(self):
+        members = self.conn.zrange('viewed:', 0, self.size - 1)
+        self.members = frozenset(
+            m.decode('utf-8') if isinstance(m, bytes) else m for m in members)
+        self.refreshed = time.time()
+        self.refreshes += 1
+
+    def run(self):
+        while not self.quit.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                self.errors += 1
+            self.quit.wait(self.interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.quit.set()
+        if self.thread:
+            self.thread.join()
+
+    def age(self):
+        return time.time() - self.refreshed
+
+    def stale(self):
+        return self.age() > self.max_age
+
+    def __contains__(self, item_id):
+        return item_id in self.members
+
+
+# 将VIEWED_SNAPSHOT设置为已经启动的ViewedSnapshot实例即可启用，
+# 例如：VIEWED_SNAPSHOT = ViewedSnapshot(conn).start()
+VIEWED_SNAPSHOT = None
+
+
 # 代码清单2-11 can_cache()函数
 def can_cache(conn, request):
     item_id = extract_item_id(request)
     if not item_id or is_dynamic(request):
         return False
+    # 有可用的本地快照时直接在内存中判断，快照过旧时退回到ZRANK
+    if VIEWED_SNAPSHOT and not VIEWED_SNAPSHOT.stale():
+        return item_id in VIEWED_SNAPSHOT
     rank = conn.zrank('viewed:', item_id)
     return rank is not None and rank < 10000
 
 
-def extract_item_id(request):
+# 解析结果在同一个请求的extract_item_id()、is_dynamic()和hash_request()之间共享，
+# 每个URL只需解析一次；调用者不能修改返回的query字典
+@functools.lru_cache(maxsize=4096)
+def parse_request(request):
     parsed = urllib.parse.urlparse(request)
-    query = urllib.parse.parse_qs(parsed.query)
+    query = urllib.parse.parse_qs(parsed.query, keep_blank_values=True)
+    return parsed, query
+
+
+def extract_item_id(request):
+    parsed, query = parse_request(request)
     return (query.get('item') or [None])[0]
 
 
 def is_dynamic(request):
-    parsed = urllib.parse.urlparse(request)
-    query = urllib.parse.urlparse(parsed.query)
+    parsed, query = parse_request(request)
     return '_' in query
 
@@ -1,10 +1,18 @@
+from collections import defaultdict
+import contextlib
+import mmap
+import multiprocessing
 import os
+import threading
 import time
 import unittest
 import uuid
 
 import redis
 
+from chapter11 import script_load
+from chapter2 import DECAY_PERIOD, VIEW_WEIGHT_LUA
+
 
 # 代码清单4-1 Redis提供的持久化配置选项
 # 快照持久化选项
@@ -28,6 +36,7 @@ def process_logs(conn, path, callback):
     # 语法：MGET KEY1 KEY2 .. KEYN
     # 返回值：一个包含所有给定 key 的值的列表。
     current_file, offset = conn.mget('progress:file', 'progress:position')
+    current_file = current_file or ''
 
     pipe = conn.pipeline()
 
@@ -79,11 +88,12 @@ def process_logs(conn, path, callback):
             # x -- 字符串或数字。
             # base -- 进制数，默认十进制
             # 返回值：返回整型数据
-            inp.seek(int(offset, 10))
+            offset = int(offset, 10)
+            inp.seek(offset)
         else:
             offset = 0
 
-        current_file = None
+        current_file = ''
         # 用于将一个可遍历的数据对象(如列表、元组或字符串)组合为一个索引序列，同时列出数据和数据下标，一般用在for循环当中。
         # Python 2.3. 以上版本可用，2.6 添加 start 参数
         # 语法：enumerate(sequence, [start=0])
@@ -93,7 +103,7 @@ def process_logs(conn, path, callback):
         # 返回值：返回 enumerate(枚举) 对象
         for lno, line in enumerate(inp):
             callback(pipe, line)
-            offset += int(offset) + len(line)
+            offset += len(line)
             if not (lno + 1) % 1000:
                 update_progress()
 
@@ -101,13 +111,118 @@ def process_logs(conn, path, callback):
         inp.close()
 
 
+# 并行处理日志：将文件映射到内存并按行边界切分为多个块，交给进程池处理
+# 每个块的进度记录在散列progress:<文件名>里，字段为块的起始偏移量，值为“已处理到的偏移量 块的结束偏移量”；
+# 进度与日志数据在同一个事务流水线里提交，所以恢复时可以从准确的位置继续
+LOG_CHUNK_SIZE = 64 * 2 ** 20
+LOG_FLUSH_BYTES = 2 ** 20
+
+LOG_CONN = None
+
+
+def split_log_chunks(data, chunk_size):
+    chunks = []
+    start = 0
+    while start < len(data):
+        end = data.find(b'\n', start + chunk_size - 1)
+        end = len(data) if end == -1 else end + 1
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+
+def plan_log_chunks(conn, path, fname, chunk_size):
+    # 已经开始处理的文件沿用记录下来的块划分，没有处理完的块从记录的位置继续
+    key = 'progress:' + fname
+    progress = conn.hgetall(key)
+    if not progress:
+        with open(os.path.join(path, fname), 'rb') as inp:
+            size = os.fstat(inp.fileno()).st_size
+            if not size:
+                return []
+            with mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                chunks = split_log_chunks(data, chunk_size)
+        progress = dict((start, '%s %s' % (start, end)) for start, end in chunks)
+        conn.hset(key, mapping=progress)
+
+    tasks = []
+    for start, value in progress.items():
+        position, end = map(int, value.split())
+        if position < end:
+            tasks.append((key, os.path.join(path, fname), start, position, end))
+    return tasks
+
+
+def process_log_chunk(conn, callback, task, flush_bytes=LOG_FLUSH_BYTES):
+    key, fname, start, position, end = task
+    pipe = conn.pipeline()
+    lines = pending = 0
+    with open(fname, 'rb') as inp:
+        with mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            while position < end:
+                eol = data.find(b'\n', position, end)
+                eol = end if eol == -1 else eol + 1
+                callback(pipe, data[position:eol])
+                pending += eol - position
+                position = eol
+                lines += 1
+                # 按照积累的字节数而不是行数提交流水线
+                if pending >= flush_bytes or position == end:
+                    pipe.hset(key, start, '%s %s' % (position, end))
+                    pipe.execute()
+                    pending = 0
+    return lines
+
+
+def log_connection_spec(conn):
+    # 连接参数中的Retry对象、锁等不能被序列化，使用spawn或forkserver启动子进程时会失败；
+    # 只传递主机、端口、数据库、密码之类的简单参数，由子进程重新建立连接
+    pool = conn.connection_pool
+    kwargs = dict((key, value) for key, value in pool.connection_kwargs.items()
+                  if isinstance(value, (str, bytes, int, float)))
+    return pool.connection_class, kwargs
+
+
+def _init_log_worker(connection_class, connection_kwargs):
+    # 子进程不能共用父进程的连接，按照相同的参数重新建立连接池
+    global LOG_CONN
+    LOG_CONN = redis.Redis(connection_pool=redis.ConnectionPool(
+        connection_class=connection_class, **connection_kwargs))
+
+
+def _process_log_chunk(args):
+    callback, task, flush_bytes = args
+    return process_log_chunk(LOG_CONN, callback, task, flush_bytes)
+
+
+def process_logs_parallel(conn, path, callback, workers=None,
+                          chunk_size=LOG_CHUNK_SIZE, flush_bytes=LOG_FLUSH_BYTES):
+    # callback需要是模块级的函数，这样才能被传递给子进程；
+    # 各个块的处理顺序是不确定的，callback不能依赖于日志行之间的先后顺序
+    tasks = []
+    for fname in sorted(os.listdir(path)):
+        tasks.extend(plan_log_chunks(conn, path, fname, chunk_size))
+
+    if workers == 1:
+        return sum(process_log_chunk(conn, callback, task, flush_bytes)
+                   for task in tasks)
+
+    pool = multiprocessing.Pool(workers, _init_log_worker, log_connection_spec(conn))
+    try:
+        return sum(pool.imap_unordered(
+            _process_log_chunk, [(callback, task, flush_bytes) for task in tasks]))
+    finally:
+        pool.close()
+        pool.join()
+
+
 # 代码清单4-3 wait_for_sync()函数
 def wait_for_sync(mconn, sconn):
     identifier = str(uuid.uuid4())
-    mconn.zadd('sync:wait', identifier, time.time())
+    mconn.zadd('sync:wait', {identifier: time.time()})
 
     # 等待从服务器完成同步
-    while not sconn.info()['master_link_status'] != 'up':
+    while sconn.info('replication')['master_link_status'] != 'up':
         time.sleep(.001)
 
     # 等待从服务器接收数据更新
@@ -117,7 +232,7 @@ def wait_for_sync(mconn, sconn):
     deadline = time.time() + 1.01
     while time.time() < deadline:
         # 检查数据更新是否已经被同步到了硬盘
-        if sconn.info()['aof_pending_bio_fsync'] == 0:
+        if sconn.info('persistence')['aof_pending_bio_fsync'] == 0:
             break
         time.sleep(.001)
 
@@ -126,6 +241,126 @@ def wait_for_sync(mconn, sconn):
     mconn.zremrangebyscore('sync:wait', 0, time.time() - 900)
 
 
+# 同步屏障：写入者完成写入之后调用wait()，同一时间只有一个线程检查同步情况，
+# 在检查期间到达的写入者会共用下一次检查，因此一批写入只需要一次同步检查
+SYNC_TIMEOUT = 1.0
+SYNC_MAX_BACKOFF = .1
+
+
+def wait_for_token(mconn, sconn, timeout=SYNC_TIMEOUT):
+    # 旧版本Redis没有WAIT命令时使用的令牌方式，轮询间隔按指数增长，
+    # 并且只获取INFO中需要的部分，而不是每毫秒获取一次完整的INFO
+    identifier = str(uuid.uuid4())
+    mconn.zadd('sync:wait', {identifier: time.time()})
+    deadline = time.time() + timeout
+    backoff = .001
+    try:
+        while not sconn.zscore('sync:wait', identifier):
+            if time.time() > deadline:
+                return False
+            time.sleep(backoff)
+            backoff = min(backoff * 2, SYNC_MAX_BACKOFF)
+
+        backoff = .001
+        while sconn.info('persistence').get('aof_pending_bio_fsync', 0):
+            if time.time() > deadline:
+                return False
+            time.sleep(backoff)
+            backoff = min(backoff * 2, SYNC_MAX_BACKOFF)
+        return True
+    finally:
+        mconn.zrem('sync:wait', identifier)
+        mconn.zremrangebyscore('sync:wait', 0, time.time() - 900)
+
+
+class SyncBarrier(object):
+    def __init__(self, mconn, sconn=None, replicas=1, aof=False,
+                 timeout=SYNC_TIMEOUT):
+        self.mconn = mconn
+        self.sconn = sconn
+        self.replicas = replicas
+        self.aof = aof
+        self.timeout = timeout
+        # 依次尝试WAITAOF、WAIT和令牌方式，遇到不支持的方式之后不再使用
+        self.modes = (['waitaof'] if aof else []) + ['wait'] + (['token'] if sconn else [])
+        self.cond = threading.Condition()
+        self.started = 0
+        self.completed = 0
+        self.running = False
+        self.result = None
+        self.waiters = 0
+        self.syncs = 0
+        self.total_lag = 0
+        self.max_lag = 0
+        self.last_lag = 0
+
+    def wait(self):
+        # 只有在当前写入完成之后才开始的检查才能覆盖这次写入
+        with self.cond:
+            self.waiters += 1
+            need = self.started + 1
+            while self.completed < need:
+                if self.running:
+                    self.cond.wait()
+                    continue
+                self.running = True
+                self.started += 1
+                generation = self.started
+                self.cond.release()
+                try:
+                    start = time.time()
+                    result = self.sync()
+                    lag = time.time() - start
+                finally:
+                    self.cond.acquire()
+                    self.running = False
+                    self.cond.notify_all()
+                self.completed = generation
+                self.result = result
+                self.syncs += 1
+                self.last_lag = lag
+                self.total_lag += lag
+                self.max_lag = max(self.max_lag, lag)
+            return self.result
+
+    def sync(self):
+        while True:
+            mode = self.modes[0]
+            try:
+                if mode == 'token':
+                    return wait_for_token(self.mconn, self.sconn, self.timeout)
+                # WAIT只等待当前连接之前的写入，所以先在同一个连接上写入一次，
+                # 这样所有写入者在此之前完成的写入都会被覆盖
+                pipe = self.mconn.pipeline(False)
+                pipe.incr('sync:barrier')
+                if mode == 'waitaof':
+                    pipe.waitaof(1, self.replicas, int(self.timeout * 1000))
+                    local, replicas = pipe.execute()[-1]
+                    return bool(local) and replicas >= self.replicas
+                pipe.wait(self.replicas, int(self.timeout * 1000))
+                return pipe.execute()[-1] >= self.replicas
+            except redis.exceptions.ResponseError as err:
+                # 只有服务器不支持当前方式时才降级；READONLY之类的临时错误直接抛出
+                message = str(err).lower()
+                unsupported = 'unknown command' in message or (
+                    mode == 'waitaof' and 'appendonly' in message)
+                if not unsupported or len(self.modes) == 1:
+                    raise
+                self.modes.pop(0)
+
+    def stats(self):
+        with self.cond:
+            return {
+                'mode': self.modes[0],
+                'writes': self.waiters,
+                'syncs': self.syncs,
+                'writes_per_sync': self.waiters / (self.syncs or 1),
+                'last_lag': self.last_lag,
+                'avg_lag': self.total_lag / (self.syncs or 1),
+                'max_lag': self.max_lag,
+            }
+
+
 # 代码清单4-4 用于替换故障主节点的一连串命令
 '''
 user@vpn-master ~:$ ssh root@machine-b.vpn                          #A
@@ -159,19 +394,23 @@ def list_item(conn, itemid, sellerid, price):
     item = "%s.%s" % (itemid, sellerid)
     end = time.time() + 5
     pipe = conn.pipeline()
-    while time.time() < end:
-        try:
-            pipe.watch(inventory)
-            if not pipe.sismember(inventory, itemid):
-                pipe.unwatch()
-                return None
-            pipe.multi()
-            pipe.zadd("market:", item, price)
-            pipe.srem(inventory, itemid)
-            pipe.execute()
-            return True
-        except redis.exceptions.WatchError:
-            pass
+    with market_timer('list_item'):
+        while time.time() < end:
+            count_market('list_item', 'attempts')
+            try:
+                pipe.watch(inventory)
+                if not pipe.sismember(inventory, itemid):
+                    pipe.unwatch()
+                    return None
+                pipe.multi()
+                pipe.zadd("market:", {item: price})
+                pipe.zadd("market:item:%s" % itemid, {sellerid: price})
+                pipe.zadd("market:best:", {itemid: price}, lt=True)
+                pipe.srem(inventory, itemid)
+                pipe.execute()
+                return True
+            except redis.exceptions.WatchError:
+                count_market('list_item', 'aborts')
         return False
 
 
@@ -184,36 +423,272 @@ def purchase_item(conn, buyerid, itemid, sellerid, lprice):
     end = time.time() + 10
     pipe = conn.pipeline()
 
-    while time.time() < end:
-        try:
-            pipe.watch("market:", buyer)
-            price = pipe.zscore("market:", item)
-            funds = int(pipe.hget(buyer, "funds"))
-            if price != lprice or price > funds:
-                pipe.unwatch()
-                return None
-
-            pipe.multi()
-            pipe.hincrby(seller, "funds", int(price))
-            pipe.hincrby(buyer, "funds", int(-price))
-            pipe.sadd(inventory, itemid)
-            pipe.zrem("market:", item)
-            pipe.execute()
-            return True
-        except redis.exceptions.WatchError:
-            pass
+    with market_timer('purchase_item'):
+        while time.time() < end:
+            count_market('purchase_item', 'attempts')
+            try:
+                pipe.watch("market:", buyer)
+                price = pipe.zscore("market:", item)
+                funds = int(pipe.hget(buyer, "funds"))
+                if price != lprice or price > funds:
+                    pipe.unwatch()
+                    return None
+
+                pipe.multi()
+                pipe.hincrby(seller, "funds", int(price))
+                pipe.hincrby(buyer, "funds", int(-price))
+                pipe.sadd(inventory, itemid)
+                pipe.zrem("market:", item)
+                pipe.zrem("market:item:%s" % itemid, sellerid)
+                refresh_best_price(pipe, itemid, True)
+                pipe.execute()
+                return True
+            except redis.exceptions.WatchError:
+                count_market('purchase_item', 'aborts')
         return False
 
 
+# 市场操作的统计数据：每种操作的尝试次数、因为WATCH失败而放弃的次数、调用次数以及耗时
+MARKET_STATS = defaultdict(float)
+MARKET_STATS_LOCK = threading.Lock()
+
+
+def count_market(name, field, amount=1):
+    with MARKET_STATS_LOCK:
+        MARKET_STATS[name + ':' + field] += amount
+
+
+@contextlib.contextmanager
+def market_timer(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        delta = time.time() - start
+        with MARKET_STATS_LOCK:
+            MARKET_STATS[name + ':calls'] += 1
+            MARKET_STATS[name + ':latency'] += delta
+            MARKET_STATS[name + ':max_latency'] = max(
+                MARKET_STATS[name + ':max_latency'], delta)
+
+
+def market_stats():
+    with MARKET_STATS_LOCK:
+        stats = dict(MARKET_STATS)
+    names = set(key.rpartition(':')[0] for key in stats)
+    result = {}
+    for name in names:
+        calls = stats.get(name + ':calls', 0)
+        attempts = stats.get(name + ':attempts', 0)
+        result[name] = {
+            'calls': calls,
+            'attempts': attempts,
+            'aborts': stats.get(name + ':aborts', 0),
+            'abort_rate': stats.get(name + ':aborts', 0) / (attempts or 1),
+            'avg_latency': stats.get(name + ':latency', 0) / (calls or 1),
+            'max_latency': stats.get(name + ':max_latency', 0),
+        }
+    return result
+
+
+def flush_market_stats(conn):
+    # 将本进程的计数器累加到Redis的stats:market散列里，以便查看所有进程的争用情况
+    with MARKET_STATS_LOCK:
+        stats = dict(MARKET_STATS)
+        MARKET_STATS.clear()
+    pipe = conn.pipeline(False)
+    for key, value in stats.items():
+        if not key.endswith(':max_latency'):
+            pipe.hincrbyfloat('stats:market', key, value)
+    pipe.execute()
+
+
+# 使用脚本实现的商品上架和购买操作，只需要一次通信往返，也不会因为争用而重试
+def list_item_script(conn, itemid, sellerid, price):
+    with market_timer('list_item_script'):
+        count_market('list_item_script', 'attempts')
+        if list_items(conn, sellerid, [(itemid, price)]):
+            return True
+
+
+def purchase_item_script(conn, buyerid, itemid, sellerid, lprice):
+    if purchase_items(conn, buyerid, [(itemid, sellerid, lprice)]) is not None:
+        return True
+
+
+def purchase_items(conn, buyerid, items):
+    # 一次购买多件商品：只有当所有商品都还在售、价格与看到的价格一致并且余额足够时才会全部购买，
+    # 否则什么也不做；items为(itemid, sellerid, lprice)的序列，返回值为花费的总额
+    items = list(dict(("%s.%s" % (itemid, sellerid), (itemid, sellerid, lprice))
+                      for itemid, sellerid, lprice in items).values())
+    keys = ["market:", "users:%s" % buyerid, "inventory:%s" % buyerid, "market:best:"]
+    args = []
+    for itemid, sellerid, lprice in items:
+        keys.extend(["users:%s" % sellerid, "market:item:%s" % itemid])
+        args.extend(["%s.%s" % (itemid, sellerid), itemid, lprice, sellerid])
+    with market_timer('purchase_items'):
+        count_market('purchase_items', 'attempts')
+        total = purchase_items_lua(conn, keys, args)
+    return None if total is None else int(total)
+
+
+purchase_items_lua = script_load('''
+local total = 0
+local prices = {}
+for i = 1, #ARGV, 4 do
+    local price = tonumber(redis.call('zscore', KEYS[1], ARGV[i]))
+    if not price or price ~= tonumber(ARGV[i+2]) then
+        return nil
+    end
+    -- 与WATCH版本的int(price)一致：每件商品的价格先取整，买家支付的就是取整后价格的总和
+    price = math.floor(price)
+    prices[#prices+1] = price
+    total = total + price
+end
+local funds = tonumber(redis.call('hget', KEYS[2], 'funds'))
+if not funds or funds < total then
+    return nil
+end
+for i, price in ipairs(prices) do
+    local itemid = ARGV[4*i-2]
+    local book = KEYS[4+2*i]
+    redis.call('hincrby', KEYS[3+2*i], 'funds', price)
+    redis.call('sadd', KEYS[3], itemid)
+    redis.call('zrem', KEYS[1], ARGV[4*i-3])
+    redis.call('zrem', book, ARGV[4*i])
+    local best = redis.call('zrange', book, 0, 0, 'withscores')
+    if best[2] then
+        redis.call('zadd', KEYS[4], best[2], itemid)
+    else
+        redis.call('zrem', KEYS[4], itemid)
+    end
+end
+redis.call('hincrby', KEYS[2], 'funds', -total)
+return total
+''')
+
+
+# 按价格索引的订单簿：除了全局的market:之外，每种商品还有一个market:item:<itemid>有序集合，
+# 成员为卖家ID，分值为价格；market:best:记录每种商品的最低价格。
+# 这样查询某种商品最便宜的N个报价，或者某个价格区间内的报价，都只需要O(log n)加上返回的元素数量
+def list_items(conn, sellerid, items):
+    # 批量上架卖家库存中的商品，items为(itemid, price)的序列，返回成功上架的数量
+    keys = ["inventory:%s" % sellerid, "market:", "market:best:"]
+    args = [sellerid]
+    for itemid, price in items:
+        keys.append("market:item:%s" % itemid)
+        args.extend([itemid, price])
+    return list_items_lua(conn, keys, args)
+
+
+list_items_lua = script_load('''
+local listed = 0
+for i = 2, #ARGV, 2 do
+    local itemid = ARGV[i]
+    local price = tonumber(ARGV[i+1])
+    if redis.call('srem', KEYS[1], itemid) == 1 then
+        redis.call('zadd', KEYS[2], price, itemid .. '.' .. ARGV[1])
+        redis.call('zadd', KEYS[3 + i / 2], price, ARGV[1])
+        local best = tonumber(redis.call('zscore', KEYS[3], itemid))
+        if not best or price < best then
+            redis.call('zadd', KEYS[3], price, itemid)
+        end
+        listed = listed + 1
+    end
+end
+return listed
+''')
+
+
+def delist_items(conn, sellerid, itemids):
+    # 批量下架商品并放回卖家的库存，返回成功下架的数量
+    keys = ["inventory:%s" % sellerid, "market:", "market:best:"]
+    keys.extend("market:item:%s" % itemid for itemid in itemids)
+    return delist_items_lua(conn, keys, [sellerid] + list(itemids))
+
+
+delist_items_lua = script_load('''
+local delisted = 0
+for i = 2, #ARGV do
+    local itemid = ARGV[i]
+    local book = KEYS[2 + i]
+    if redis.call('zrem', KEYS[2], itemid .. '.' .. ARGV[1]) == 1 then
+        redis.call('zrem', book, ARGV[1])
+        redis.call('sadd', KEYS[1], itemid)
+        local best = redis.call('zrange', book, 0, 0, 'withscores')
+        if best[2] then
+            redis.call('zadd', KEYS[3], best[2], itemid)
+        else
+            redis.call('zrem', KEYS[3], itemid)
+        end
+        delisted = delisted + 1
+    end
+end
+return delisted
+''')
+
+
+def refresh_best_price(conn, itemid, force_eval=False):
+    # 根据商品的订单簿重新计算它的最低价格，在事务流水线里调用时需要传入force_eval=True
+    return refresh_best_price_lua(
+        conn, ["market:item:%s" % itemid, "market:best:"], [itemid], force_eval)
+
+
+refresh_best_price_lua = script_load('''
+local best = redis.call('zrange', KEYS[1], 0, 0, 'withscores')
+if best[2] then
+    return redis.call('zadd', KEYS[2], best[2], ARGV[1])
+end
+return redis.call('zrem', KEYS[2], ARGV[1])
+''')
+
+
+def cheapest_listings(conn, itemid, num=10):
+    # 某种商品最便宜的num个报价，返回[(sellerid, price), ...]
+    return conn.zrange("market:item:%s" % itemid, 0, num - 1, withscores=True)
+
+
+def listings_in_price_range(conn, low, high, itemid=None, start=0, num=20):
+    # 价格在[low, high]之间的报价；不指定商品时在全局的market:中查找，返回的成员为“itemid.sellerid”
+    key = "market:item:%s" % itemid if itemid is not None else "market:"
+    return conn.zrangebyscore(key, low, high, start=start, num=num, withscores=True)
+
+
+def cheapest_items(conn, low='-inf', high='inf', start=0, num=20):
+    # 按照最低价格查找商品，返回[(itemid, 最低价格), ...]
+    return conn.zrangebyscore("market:best:", low, high, start=start, num=num, withscores=True)
+
+
+def rebuild_order_book(conn, batch=1000):
+    # 根据已有的market:数据生成订单簿，用于迁移在订单簿出现之前上架的商品
+    itemids = set()
+    pipe = conn.pipeline(False)
+    for count, (item, price) in enumerate(conn.zscan_iter("market:", count=batch), 1):
+        itemid, _, sellerid = item.rpartition('.')
+        pipe.zadd("market:item:%s" % itemid, {sellerid: price})
+        itemids.add(itemid)
+        if not count % batch:
+            pipe.execute()
+    pipe.execute()
+    itemids = list(itemids)
+    for i in range(0, len(itemids), batch):
+        for itemid in itemids[i:i + batch]:
+            refresh_best_price(pipe, itemid, True)
+        pipe.execute()
+    return len(itemids)
+
+
 # 代码清单4-7 之前在2.5节中展示过的update_token()函数
+# 注意：代码清单4-7和4-8保持书中的写法，按权重1累加viewed:，只用于性能测试，
+# 不能与chapter2.decay_viewed()的惰性衰减一起使用；需要衰减时使用update_token_script()
 def update_token(conn, token, user, item=None):
     timestamp = time.time()
     conn.hset('login:', token, user)
-    conn.zadd('recent:', token, timestamp)
+    conn.zadd('recent:', {token: timestamp})
     if item:
-        conn.zadd('viewed:' + token, item, timestamp)
+        conn.zadd('viewed:' + token, {item: timestamp})
         conn.zremrangebyrank('viewed:' + token, 0, -26)
-        conn.zincry('viewed:', item, -1)
+        conn.zincrby('viewed:', -1, item)
 
 
 # 代码清单4-8 update_token_pipeline()函数
@@ -221,14 +696,33 @@ def update_token_pipeline(conn, token, user, item=None):
     timestamp = time.time()
     pipe = conn.pipeline(False)
     pipe.hset('login:', token, user)
-    pipe.zadd('recent:', token, timestamp)
+    pipe.zadd('recent:', {token: timestamp})
     if item:
-        pipe.zadd('viewed:' + token, item, timestamp)
+        pipe.zadd('viewed:' + token, {item: timestamp})
         pipe.zremrangebyrank('viewed:' + token, 0, -26)
-        pipe.zincrby('viewed:', item, -1)
+        pipe.zincrby('viewed:', -1, item)
     pipe.execute()
 
 
+# 使用脚本实现的update_token()，与流水线版本一样只需要一次通信往返；
+# 在流水线里调用时需要传入force_eval=True
+def update_token_script(conn, token, user, item=None, force_eval=False):
+    return update_token_lua(
+        conn, ['login:', 'recent:', 'viewed:' + token, 'viewed:', 'decay:viewed:'],
+        [token, user, time.time(), item or '', DECAY_PERIOD], force_eval)
+
+
+update_token_lua = script_load(VIEW_WEIGHT_LUA + '''
+redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+redis.call('zadd', KEYS[2], ARGV[3], ARGV[1])
+if ARGV[4] ~= '' then
+    redis.call('zadd', KEYS[3], ARGV[3], ARGV[4])
+    redis.call('zremrangebyrank', KEYS[3], 0, -26)
+    redis.call('zincrby', KEYS[4], -view_weight(KEYS[5], tonumber(ARGV[3]), tonumber(ARGV[5])), ARGV[4])
+end
+''')
+
+
 # 代码清单4-9 benchmark_update_token()函数
 def benchmark_update_token(conn, duration):
     for function in (update_token, update_token_pipeline):
@@ -1,4 +1,5 @@
 import bisect
+from collections import deque
 import contextlib
 import csv
 from datetime import datetime
@@ -36,7 +37,7 @@ SEVERITY = {
 # 遍历语法：
 # for iterating_var in sequence:
 #    statements(s)
-SEVERITY.update((name, name) for name in SEVERITY.values())
+SEVERITY.update((name, name) for name in list(SEVERITY.values()))
 
 
 def log_recent(conn, name, message, severity=logging.INFO, pipe=None):
@@ -62,6 +63,113 @@ def log_recent(conn, name, message, severity=logging.INFO, pipe=None):
     pipe.execute()
 
 
+# log_recent()的批量版本，可以作为标准的logging.Handler使用：日志先缓存在进程内，
+# 按照目标列表recent:<name>:<severity>分组，由后台线程每隔interval秒为每个分组执行一次
+# 多值LPUSH和一次LTRIM。每个分组只保留最新的100条（更早的日志反正会被LTRIM删除），
+# 缓存的日志总数超过max_records时丢弃新的日志并计数，不会阻塞写日志的线程
+class RecentLogHandler(logging.Handler):
+    def __init__(self, conn, log_name=None, interval=.1, max_records=10000,
+                 level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.conn = conn
+        self.log_name = log_name
+        self.interval = interval
+        self.max_records = max_records
+        self.groups = {}
+        self.pending = 0
+        self.dropped = self.trimmed = self.flushes = self.flushed = self.errors = 0
+        self.buffer_lock = threading.Lock()
+        # logging.shutdown()的flush()可能与后台线程的写入同时进行，
+        # 写入必须按照交换缓存的顺序执行，否则recent:*中日志的先后顺序会颠倒
+        self.flush_lock = threading.Lock()
+        self.quit = threading.Event()
+        self.thread = None
+
+    def emit(self, record):
+        try:
+            message = time.asctime() + ' ' + self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        severity = str(SEVERITY.get(record.levelno, record.levelname)).lower()
+        destination = 'recent:%s:%s' % (self.log_name or record.name, severity)
+        if self.thread is None and not self.quit.is_set():
+            # 通过dictConfig()或者addHandler()添加的处理器不会调用start()，在第一次写日志时启动后台线程
+            self.start()
+        with self.buffer_lock:
+            if self.pending >= self.max_records:
+                self.dropped += 1
+                return
+            group = self.groups.get(destination)
+            if group is None:
+                group = self.groups[destination] = deque(maxlen=100)
+            if len(group) == group.maxlen:
+                self.trimmed += 1
+            else:
+                self.pending += 1
+            group.append(message)
+
+    def flush(self):
+        with self.flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self.buffer_lock:
+            groups, self.groups = self.groups, {}
+            count, self.pending = self.pending, 0
+        if not groups:
+            return 0
+
+        pipe = self.conn.pipeline()
+        for destination, messages in groups.items():
+            # 最早的日志先推入，与逐条调用log_recent()得到的顺序相同
+            pipe.lpush(destination, *messages)
+            pipe.ltrim(destination, 0, 99)
+        try:
+            pipe.execute()
+        except Exception:
+            # 日志写入失败时不重新放回缓存，以免在Redis不可用时占用越来越多的内存
+            with self.buffer_lock:
+                self.errors += 1
+                self.dropped += count
+            return 0
+        with self.buffer_lock:
+            self.flushes += 1
+            self.flushed += count
+        return count
+
+    def run(self):
+        while not self.quit.wait(self.interval):
+            self.flush()
+        self.flush()
+
+    def start(self):
+        with self.buffer_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return self
+
+    def close(self):
+        # logging.shutdown()会在进程退出时调用close()，写入剩余的日志
+        self.quit.set()
+        if self.thread:
+            self.thread.join()
+        self.flush()
+        logging.Handler.close(self)
+
+    def stats(self):
+        with self.buffer_lock:
+            return {
+                'pending': self.pending,
+                'flushes': self.flushes,
+                'flushed': self.flushed,
+                'dropped': self.dropped,
+                'trimmed': self.trimmed,
+                'errors': self.errors,
+            }
+
+
 # 代码清单5-2 log_common()函数
 def log_common(conn, name, message, severity=logging.INFO, timeout=5):
     severity = str(SEVERITY.get(severity, severity)).lower()
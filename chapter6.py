@@ -1,8 +1,11 @@
+import binascii
 import bisect
 from collections import defaultdict, deque
 import json
 import math
 import os
+import queue
+import threading
 import time
 import unittest
 import uuid
@@ -464,6 +467,122 @@ def leave_chat(conn, chat_id, user):
         conn.zremrangebyscore('msgs:' + chat_id, 0, oldest[0][1])
 
 
+# 可复用的订阅者（用于3.6节介绍的发布与订阅）：监听线程只负责接收消息，消息按频道分配给固定的工作线程处理，
+# 同一频道的消息总是由同一个线程按顺序处理，处理较慢的频道不会拖慢整个订阅。
+# 每个工作线程的队列长度有限：policy='block'时队列满了监听线程会等待（反压），
+# policy='shed'时直接丢弃新消息并计入dropped
+class PubSubDispatcher(object):
+    def __init__(self, conn, handler, workers=4, queue_size=1000, policy='block'):
+        self.conn = conn
+        self.handler = handler
+        self.policy = policy
+        self.queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self.pubsub = conn.pubsub(ignore_subscribe_messages=True)
+        self.received = self.processed = self.dropped = self.errors = 0
+        self.listen_errors = 0
+        self.last_lag = self.max_lag = 0.0
+        self.lock = threading.Lock()
+        self.quit = threading.Event()
+        self.threads = []
+
+    def subscribe(self, *channels):
+        self.pubsub.subscribe(*channels)
+
+    def psubscribe(self, *patterns):
+        self.pubsub.psubscribe(*patterns)
+
+    def start(self):
+        self.threads = [threading.Thread(target=self.work, args=(q,), daemon=True)
+                        for q in self.queues]
+        self.threads.append(threading.Thread(target=self.listen, daemon=True))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def listen(self):
+        backoff = .1
+        while not self.quit.is_set():
+            try:
+                message = self.pubsub.get_message(timeout=.1)
+            except Exception:
+                # 连接断开等错误不能让监听线程退出：记录错误，等待一段时间之后重新连接，
+                # 重新建立连接时redis-py会自动重新订阅之前的频道和模式
+                with self.lock:
+                    self.listen_errors += 1
+                if self.pubsub.connection:
+                    self.pubsub.connection.disconnect()
+                self.quit.wait(backoff)
+                backoff = min(backoff * 2, 5)
+                continue
+            backoff = .1
+            if message:
+                self.dispatch(message)
+
+    def dispatch(self, message):
+        channel = message['channel']
+        if isinstance(channel, str):
+            channel = channel.encode('utf-8')
+        q = self.queues[binascii.crc32(channel) % len(self.queues)]
+        item = (time.time(), message)
+        with self.lock:
+            self.received += 1
+        if self.policy == 'shed':
+            try:
+                q.put_nowait(item)
+            except queue.Full:
+                with self.lock:
+                    self.dropped += 1
+            return
+        while not self.quit.is_set():
+            try:
+                q.put(item, timeout=.1)
+                return
+            except queue.Full:
+                pass
+
+    def work(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            received, message = item
+            lag = time.time() - received
+            try:
+                self.handler(message)
+            except Exception:
+                with self.lock:
+                    self.errors += 1
+            with self.lock:
+                self.processed += 1
+                self.last_lag = lag
+                self.max_lag = max(self.max_lag, lag)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'depth': sum(q.qsize() for q in self.queues),
+                'received': self.received,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'listen_errors': self.listen_errors,
+                'last_lag': self.last_lag,
+                'max_lag': self.max_lag,
+            }
+
+    def stop(self):
+        # 先停止接收，再等待各个队列中已有的消息处理完毕
+        self.quit.set()
+        if self.threads:
+            self.threads[-1].join()
+            for q in self.queues:
+                q.put(None)
+            for thread in self.threads[:-1]:
+                thread.join()
+            self.threads = []
+        self.pubsub.close()
+
+
 # 代码清单6-29 一个本地聚合计算回调函数，用于每天以国家维度对日志进行聚合
 aggregates = defaultdict(lambda: defaultdict(int))
 
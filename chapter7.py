@@ -1,3 +1,4 @@
+import heapq
 import math
 import re
 import unittest
@@ -177,6 +178,20 @@ def search_and_sort(conn, query, id=None, ttl=300, sort="-updated",
     if not id:
         id = parse_and_search(conn, query, ttl=ttl)
 
+    # 结果集较大时，SORT对每个元素都要在Redis单线程上查找一次散列并排序整个集合；
+    # 此时改为使用预先生成的排序有序集合，或者在客户端分批获取排序字段并只保留前k个
+    size = conn.scard('idx:' + id)
+    if size > SORT_CLIENT_THRESHOLD:
+        if sort in SORT_ZSETS and conn.exists('idx:' + SORT_ZSETS[sort]):
+            # 排序有序集合缺少某些文档时，求交集会丢掉这些文档，而SORT会把缺失的字段当作0，
+            # 所以只有在没有文档丢失时才使用有序集合的结果
+            docids = sort_by_zset(
+                conn, id, SORT_ZSETS[sort], size, ttl, desc, start, num)
+            if docids is not None:
+                return size, docids, id
+        return size, sort_by_hash_field(
+            conn, 'idx:' + id, "kb:doc:", sort, alpha, desc, start, num), id
+
     pipeline = conn.pipeline(True)
     pipeline.scard('idx:' + id)
 
@@ -215,6 +230,77 @@ def search_and_sort(conn, query, id=None, ttl=300, sort="-updated",
     return results[0], results[1], id
 
 
+# 结果集的元素数量超过这个值时，改为在客户端进行排序
+SORT_CLIENT_THRESHOLD = 1000
+# 每个流水线获取的排序字段数量
+SORT_FETCH_BATCH = 500
+# 预先生成的排序有序集合：文档属性 -> 有序集合（不含“idx:”前缀），分值为属性值
+SORT_ZSETS = {
+    'updated': 'sort:update',
+}
+
+
+def index_sort_field(conn, docid, field, value):
+    # 更新文档属性的同时维护对应的排序有序集合
+    pipeline = conn.pipeline(True)
+    pipeline.hset('kb:doc:' + docid, field, value)
+    if field in SORT_ZSETS:
+        pipeline.zadd('idx:' + SORT_ZSETS[field], {docid: value})
+    pipeline.execute()
+
+
+def fetch_sort_keys(conn, members, prefix, field, alpha):
+    # 使用非事务流水线分批执行HMGET，只取回排序所需的字段
+    members = list(members)
+    for i in range(0, len(members), SORT_FETCH_BATCH):
+        batch = members[i:i + SORT_FETCH_BATCH]
+        pipeline = conn.pipeline(False)
+        for member in batch:
+            pipeline.hmget(prefix + member, [field])
+        for member, (value,) in zip(batch, pipeline.execute()):
+            # 与SORT一样，缺失的字段按0或者空字符串处理
+            if alpha:
+                yield value or '', member
+            else:
+                yield float(value or 0), member
+
+
+def sort_by_hash_field(conn, key, prefix, field, alpha=False, desc=False,
+                       start=0, num=20):
+    # 只保留前start+num个元素的部分排序，代替SORT key BY prefix*->field
+    keys = fetch_sort_keys(conn, conn.smembers(key), prefix, field, alpha)
+    top = (heapq.nlargest if desc else heapq.nsmallest)(start + num, keys)
+    return [member for value, member in top[start:]]
+
+
+def sort_by_zset(conn, id, zset, size, ttl=300, desc=True, start=0, num=20):
+    # 将搜索结果与排序有序集合求交集，搜索结果的权重为0，因此分值就是属性值。
+    # 交集和“是否覆盖了全部文档”的检查结果与搜索结果使用相同的过期时间，
+    # 同一个搜索的后续翻页只需要执行ZRANGE；有文档缺失时返回None
+    sorted_key = 'idx:%s:%s' % (id, zset)
+    status_key = 'sorted:%s:%s' % (id, zset)
+    pipeline = conn.pipeline(True)
+    pipeline.get(status_key)
+    pipeline.expire(sorted_key, ttl)
+    pipeline.expire(status_key, ttl)
+    status, exists, _ = pipeline.execute()
+
+    if status is None or (int(status) and not exists):
+        pipeline.zinterstore(sorted_key, {'idx:' + id: 0, 'idx:' + zset: 1})
+        pipeline.expire(sorted_key, ttl)
+        status = int(pipeline.execute()[0] == size)
+        pipeline.set(status_key, status, ex=ttl)
+        if not status:
+            pipeline.delete(sorted_key)
+        pipeline.execute()
+    if not int(status):
+        return None
+
+    if desc:
+        return conn.zrevrange(sorted_key, start, start + num - 1)
+    return conn.zrange(sorted_key, start, start + num - 1)
+
+
 # 代码清单7-6 更新之后的函数可以进行搜索并同时基于投票数量和更新时间进行排序
 def search_and_zsort(conn, query, id=None, ttl=300, update=1, vote=0, start=0, num=20, desc=True):
     if id and not conn.expire(id, ttl):
@@ -248,10 +334,9 @@ def _zset_common(conn, method, scores, ttl=30, **kw):
     id = str(uuid.uuid4())
     execute = kw.pop('_execute', True)
     pipeline = conn.pipeline(True) if execute else conn
-    for key in scores.keys():
-        scores['idx:' + key] = scores.pop(key)
+    scores = dict(('idx:' + key, weight) for key, weight in scores.items())
     getattr(pipeline, method)('idx:' + id, scores, **kw)
-    pipeline.execute('idx:' + id, ttl)
+    pipeline.expire('idx:' + id, ttl)
     if execute:
         pipeline.execute()
     return id